@@ -1,28 +1,40 @@
-import asyncio, random, re, traceback
+import asyncio, cProfile, pstats, random, re, sys, traceback
 from collections import deque, OrderedDict
 from dataclasses import dataclass
 from datetime    import datetime
+from os.path     import basename, dirname, join as path_join
 from heapq       import heappush
 from random      import randint
-from time        import monotonic, time
-from typing      import Any, Deque, Dict, List, Optional, Tuple
+from time        import monotonic, perf_counter, time
+from typing      import (Any, Deque, Dict, Iterable, List, Optional, Pattern,
+    Tuple, Union)
 from typing      import OrderedDict as TOrderedDict
 
 from irctokens import build, Line, Hostmask
 from ircrobots import Bot as BaseBot
 from ircrobots import Server as BaseServer
+from ircrobots.interface import SendPriority
 
 from ircstates.numerics   import *
 from ircrobots.matching   import Response, ANY, Folded, SELF
 from ircchallenge         import Challenge
 
 from .config   import Config
-from .database import Database
-
-from .common   import Event, MaskAction, MaskModifier, User
+from .database import Database, MaskDetails
+from .sync     import SyncOwner, SyncSubscriber
+from .metrics  import METRICS, Sample
+from .reports  import ReportAggregator
+from .audit    import Audit, CoHits, audit_report
+from .clusters import ClusterDetector
+from .velocity import velocity_parse, velocity_tostring, VelocityCounter
+from .maskfile import history_scan, masks_compile, masks_read, masks_write
+
+from .common   import CIDRMask, CIDRTable, Event, Mask, MaskAction
+from .common   import MaskModifier, User, mask_references, mask_uflags
 from .common   import (mask_compile, mask_find, mask_token, mtype_weight,
     mtype_tostring, mtype_fromstring, mtype_getaction)
-from .common   import from_pretty_time, to_pretty_time
+from .common   import format_strip, from_pretty_time, to_pretty_time
+from .common   import Template, template_compile, template_render
 
 # not in ircstates yet...
 RPL_RSACHALLENGE2      = "740"
@@ -32,12 +44,45 @@ RPL_YOUREOPER          = "381"
 
 RE_OPERNAME = re.compile(r"^is opered as (\S+)(?:,|$)")
 
+# how far the record and report stages can fall behind mask_check before
+# their work is dropped
+STAGE_QUEUE_SIZE = 10_000
+# recent hits we keep per mask, for GETMASK -hits
+MASK_RECENT_HITS = 10
+# recent would-have-hits we keep per shadow mask
+SHADOW_SAMPLES = 10
+# values of each field we keep counts of when looking for clone clusters
+CLUSTER_SKETCH_SIZE = 200
+# entries per page of list-style commands' output
+PAGE_SIZE = 20
+# what we put between entries packed in to one line of output
+PACK_SEPARATOR = " | "
+# most functions PROFILE will list
+PROFILE_COUNT_MAX = 50
+# while degraded, only keep every nth connection in match history
+DEGRADED_HISTORY_SAMPLE = 10
+# how long after one of our servers sees a connection the others might still
+# be seeing the same one
+CONNECT_CLAIM_TTL = 5.0
+
+# template values that differ for every matched connection
+FORMAT_DYNAMIC = {
+    "nick", "user", "host", "ip", "ban_user", "ban_host", "ban_time"
+}
+
 @dataclass
 class Caller(object):
     source: str
     nick:   str
     oper:   str
 
+class ShadowStats(object):
+    # what a shadow mask would have hit since we loaded it
+    def __init__(self):
+        self.since   = monotonic()
+        self.hits    = 0
+        self.samples: Deque[str] = deque(maxlen=SHADOW_SAMPLES)
+
 # decorator, for command usage strings
 def usage(usage_string: str):
     def usage_inner(object: Any):
@@ -48,9 +93,70 @@ def usage(usage_string: str):
         return object
     return usage_inner
 
+# decorator, for commands that change masks or reasons
+def mutates(object: Any):
+    object._mutates = True
+    return object
+
 class UsageError(Exception):
     pass
 
+def _masks_compile(masks: List[str]) -> List[Optional[Mask]]:
+    # run in an executor thread, away from the event loop
+    out: List[Optional[Mask]] = []
+    for mask in masks:
+        try:
+            out.append(mask_compile(mask))
+        except (ValueError, re.error):
+            traceback.print_exc()
+            out.append(None)
+    return out
+
+def _page_args(words: List[str]) -> Tuple[List[str], int, Optional[str]]:
+    # pulls `-page <n>` and `-file <name>` out of a command's arguments
+    rest: List[str] = []
+    page = 1
+    filename: Optional[str] = None
+    while words:
+        word = words.pop(0)
+        if word in {"-page", "-file"}:
+            if not words:
+                raise UsageError(f"{word} needs a value")
+            value = words.pop(0)
+            if word == "-file":
+                filename = value
+            elif not value.isdigit() or int(value) < 1:
+                raise UsageError("page must be a number above 0")
+            else:
+                page = int(value)
+        else:
+            rest.append(word)
+    return (rest, page, filename)
+
+def _write_new(path: str, text: str):
+    # run in an executor thread, away from the event loop
+    with open(path, "x", encoding="utf8") as file:
+        file.write(text)
+
+def _page_footer(
+        page:    int,
+        total:   int,
+        summary: str,
+        command: str
+        ) -> List[str]:
+
+    pages = max(1, -(-total // PAGE_SIZE))
+    if page > pages:
+        # nothing was listed
+        return [f"{summary} (no page {page}, the last is {pages})"]
+    outs  = [f"{summary} (page {page} of {pages})"]
+    if page < pages:
+        outs.append(f"next: {command} -page {page+1}")
+    return outs
+
+def _page_slice(entries: List[str], page: int) -> List[str]:
+    return entries[(page-1)*PAGE_SIZE:page*PAGE_SIZE]
+
 class Server(BaseServer):
     def __init__(self,
             bot:      BaseBot,
@@ -62,15 +168,36 @@ class Server(BaseServer):
         self._config   = config
         self._database = database
 
+        # masks, reasons and history are shared between servers on the Bot.
+        # everything here is about this server connection's view of things
         self._users:          Dict[str, User] = {}
-        self._recent_masks:   Deque[List[str]] = deque()
-        self.active_masks:    TOrderedDict[int, Pattern] = OrderedDict()
-        self._reasons:        Dict[str, str] = {}
 
         self.delayed_send: List[Tuple[int, str]] = []
+        self.reports = ReportAggregator(
+            config.report_rate, config.report_window
+        )
 
         self.to_check: Deque[Tuple[float, str, User]] = deque()
-        self._nick_change_whois: Deque[str] = deque()
+        self._nick_change_whois: Deque[Tuple[float, str]] = deque()
+
+        # overloaded: to_check filled up, so we're skipping WHOIS, sampling
+        # history and not sending verbose reports until the wave passes
+        self.degraded        = False
+        self.degraded_checks = 0
+        self._degraded_at    = 0.0
+        self._degraded_rate  = 0.0
+        self._degraded_told  = False
+        # cliconns seen, for working out the connect rate
+        self.connects       = 0
+        self._rate_connects = 0
+        self._rate_at       = monotonic()
+
+        # (casefolded nick, user, host): (expire time, oper name)
+        self._oper_cache: Dict[
+            Tuple[str, Optional[str], Optional[str]], Tuple[float, str]
+        ] = {}
+        # casefolded nick: WHOIS in flight
+        self._oper_pending: Dict[str, "asyncio.Task[Optional[str]]"] = {}
 
     def set_throttle(self, rate: int, time: float):
         # turn off throttling
@@ -112,7 +239,46 @@ class Server(BaseServer):
         else:
             await self.send(build("OPER", [oper_name, oper_pass]))
 
-    async def _get_oper(self, nickname: str):
+    async def _get_oper(self, hostmask: Hostmask) -> Optional[str]:
+        nickname = hostmask.nickname
+        key      = self.casefold(nickname)
+        # whoever has this nick next, even if we missed them taking it,
+        # won't be this source
+        source   = (key, hostmask.username, hostmask.hostname)
+        if source in self._oper_cache:
+            expire, oper = self._oper_cache[source]
+            if expire > monotonic():
+                return oper
+            del self._oper_cache[source]
+
+        if key in self._oper_pending:
+            # share an in-flight WHOIS for the same caller
+            return await asyncio.shield(self._oper_pending[key])
+
+        task = asyncio.ensure_future(self._whois_oper(nickname))
+        self._oper_pending[key] = task
+        try:
+            oper = await asyncio.shield(task)
+        finally:
+            current = self._oper_pending.get(key, None)
+            if current is task:
+                del self._oper_pending[key]
+
+        # only cache known opers, and only if the caller's nick didn't
+        # change or quit while we were waiting for the WHOIS
+        if oper is not None and current is task:
+            expire = monotonic() + self._config.oper_cache
+            self._oper_cache[source] = (expire, oper)
+        return oper
+
+    def _forget_oper(self, nickname: str):
+        key = self.casefold(nickname)
+        # only ever as many as there are opers talking to us
+        for source in [s for s in self._oper_cache if s[0] == key]:
+            del self._oper_cache[source]
+        self._oper_pending.pop(key, None)
+
+    async def _whois_oper(self, nickname: str) -> Optional[str]:
         await self.send(build("WHOIS", [nickname]))
 
         whois_oper = Response(RPL_WHOISOPERATOR, [SELF, Folded(nickname)])
@@ -131,96 +297,151 @@ class Server(BaseServer):
         return None
 
     def _format(self,
-            string: str,
-            extras: Dict[str, str]
-            ):
-
-        formats = self._reasons.copy()
-        formats.update(extras)
-        # sort keys by length backwards
-        # "$user_reason" will match $user if we don't
-        fkeys   = sorted(formats.keys(), key=len, reverse=True)
-
-        # expand reason templates
-        for i in range(10):
-            changed = False
-            for key in fkeys:
-                fkey = f"${key}"
-                if fkey in string:
-                    changed = True
-                    string = string.replace(fkey, formats[key])
-            if not changed:
-                # don't keep going if nothing changes
+            string:  str,
+            mask_id: int,
+            reason:  str,
+            values:  Dict[str, Optional[str]]
+            ) -> str:
+
+        key = (string, mask_id, reason)
+        if not key in self.bot.templates:
+            # everything but per-connection values is expanded once, here,
+            # and thrown away when reason templates change
+            user_reason, _, oper_reason = reason.partition("|")
+            statics = self.bot.reasons.copy()
+            statics.update({
+                "mask_id":     str(mask_id),
+                "reason":      reason,
+                "user_reason": user_reason,
+                "oper_reason": oper_reason
+            })
+            self.bot.templates[key] = template_compile(
+                string, statics, FORMAT_DYNAMIC
+            )
+
+        return template_render(self.bot.templates[key], values).rstrip()
+
+    def reap_users(self) -> int:
+        # `_users` is ordered by `.seen`, oldest first, so we only ever need
+        # to look at the stale end of it
+        max_age = self._config.users_maxage
+        excess  = len(self._users) - self._config.users_max
+        now     = monotonic()
+
+        stale: List[str] = []
+        for nick, user in self._users.items():
+            if excess > 0 or (now - user.seen) > max_age:
+                stale.append(nick)
+                excess -= 1
+            else:
                 break
-        return string.rstrip()
 
-    async def _idle_reset(self):
-        # send ourselves a PM to reset our idle time
+        for nick in stale:
+            del self._users[nick]
+        return len(stale)
+
+    def _idle_reset(self):
+        # send ourselves a PM to reset our idle time. nothing waits for it to
+        # actually be sent
         if self._config.antiidle:
-            await self.send(build("PRIVMSG", [self.nickname, "hello self"]))
+            self.send(
+                build("PRIVMSG", [self.nickname, "hello self"]),
+                SendPriority.LOW
+            )
 
     async def _mask_match(self,
             nick:  str,
             user:  User,
             event: Event
-            ) -> List[int]:
-
-        uflags = "".join([
-            "0" if user.account is None   else "1",
-            "0" if not user.secure        else "1",
-            "0" if event == Event.CONNECT else "1",
-            "\n"
-        ])
-
-        ni = nick
-        us = user.user
-        ho = user.host
-        ip = user.ip
-        re = user.real
-
-        references = [f"{uflags}{ni}!{us}@{ho} {re}"]
-        if user.ip is not None and not user.host == user.ip:
-            # if the user has an IP and IP != host, also match against IP
-            references.append(f"{uflags}{ni}!{us}@{ip} {re}")
+            ) -> Tuple[List[int], List[str]]:
+
+        uflags     = mask_uflags(user, event)
+        references = mask_references(uflags, nick, user)
+
+        if (not self.degraded or
+                self.connects % DEGRADED_HISTORY_SAMPLE == 0):
+            self.bot.recent_masks.append(references)
+            if len(self.bot.recent_masks) > self._config.history:
+                self.bot.recent_masks.popleft()
+        if event == Event.CONNECT and self._config.cluster_window > 0:
+            self.bot.stage_put(
+                "clusters", self.bot.cluster_queue, (nick, user)
+            )
 
-        self._recent_masks.append(references)
-        if len(self._recent_masks) > self._config.history:
-            self._recent_masks.popleft()
+        if self.bot.masks_pending:
+            # we're still compiling masks in the background. don't let
+            # anything past that we'd otherwise have caught, but don't do
+            # that compiling here on the event loop either
+            await self.bot.masks_wait()
 
         matches: List[int] = []
-        for mask_id, pattern in self.active_masks.items():
+        for mask_id, pattern in self.bot.mask_regexes:
             for ref in references:
                 if pattern.search(ref):
                     matches.append(mask_id)
                     # skip to the next mask
                     break
-        return matches
+
+        if self.bot.mask_cidrs:
+            ip = user.ip if user.ip is not None else user.host
+            cidr_matches = self.bot.mask_cidrs.lookup(ip, uflags)
+            if cidr_matches:
+                matches.extend(cidr_matches)
+                matches.sort()
+        # and the references we matched against, for the shadow stage
+        return (matches, references)
+
+    async def _mask_act(self,
+            mask_id: int,
+            mtype:   int,
+            action:  str):
+
+        if mtype & MaskModifier.DELAY:
+            when = monotonic()
+            if mtype & MaskModifier.QUICK:
+                when += 3
+            else:
+                when += random.uniform(1,10)
+
+            heappush(self.delayed_send, (when, action))
+        else:
+            # queued ahead of anything else we've got to send, but we don't
+            # wait for it to be written before carrying on
+            self.send_raw(action, SendPriority.HIGH)
 
     async def mask_check(self,
             nick:  str,
             user:  User,
             event: Event):
 
-        await self._idle_reset()
-        match_ids = await self._mask_match(nick, user, event)
-        if match_ids:
-            for match_id in match_ids:
-                await self._database.masks.hit(match_id)
+        # match, then decide and act from what's in memory. recording hits
+        # and reporting are queued for later stages, which can fall behind
+        # (and shed work) without holding up the action
+        start = perf_counter()
+        match_ids, references = await self._mask_match(nick, user, event)
+        METRICS.observe("bismite_mask_match_seconds", perf_counter()-start)
+
+        # get all (mask id, details) for matched IDs
+        matches = [(i, await self.bot.mask_get(i)) for i in match_ids]
+        # velocity masks only count once they've matched often enough
+        matches = [
+            (i, d) for i, d in matches
+            if d.velocity is None or self.bot.velocity.hit(i, d.velocity, user)
+        ]
+        match_ids = [i for i, _ in matches]
 
-            # get all (mask, details) for matched IDs
-            matches = [(i, await self._database.masks.get(i)) \
-                for i in match_ids]
-            types   = {d.type for i, (m, d) in matches}
+        if matches:
+            types   = {d.type for i, d in matches}
 
             # sort by mask type, descending
             # this should order: exclude, lethal, kill, resv, warn
             matches.sort(
-                key=lambda m: mtype_weight(m[1][1].type),
+                key=lambda m: mtype_weight(m[1].type),
                 reverse=True
             )
 
-            mask_id, (mask, d) = matches[0]
-            mtype_action       = mtype_getaction(d.type)
+            mask_id, d   = matches[0]
+            mtype_action = mtype_getaction(d.type)
 
             user_reason, _, oper_reason = d.reason.partition("|")
 
@@ -233,7 +454,6 @@ class Server(BaseServer):
                 ban_host = user.ip
 
             info = {
-                "mask_id":     str(mask_id),
                 "nick":        nick,
                 "user":        user.user,
                 "host":        user.host,
@@ -241,52 +461,132 @@ class Server(BaseServer):
 
                 "ban_user":    ban_user,
                 "ban_host":    ban_host,
-                "ban_time":    str(randint(160, 320)),
-
-                "reason":      d.reason,
-                "user_reason": user_reason,
-                "oper_reason": oper_reason
+                "ban_time":    str(randint(160, 320))
             }
 
             action: Optional[str] = None
             if   mtype_action == MaskAction.LETHAL:
-                action = self._format(self._config.bancmd, info)
+                action = self._format(
+                    self._config.bancmd, mask_id, d.reason or "", info
+                )
             elif mtype_action == MaskAction.KILL:
                 action = f"KILL {nick} :{user_reason}"
             elif mtype_action == MaskAction.RESV:
                 action = f"RESV 60 {nick} ON * :bismite mask {mask_id}"
 
-            if action is None:
-                pass
-            elif d.type & MaskModifier.DELAY:
-                when = monotonic()
-                if d.type & MaskModifier.QUICK:
-                    when += 3
+            # a botnet reconnecting from one host matches over and over.
+            # the first k-line (or resv) covers the rest, so only send that
+            target: Optional[Tuple[str, str]] = None
+            ttl = self._config.action_ttl
+            if   mtype_action == MaskAction.LETHAL:
+                target = ("ban", f"{ban_user}@{ban_host}")
+            elif mtype_action == MaskAction.RESV:
+                target = ("resv", self.casefold(nick))
+                # the resv itself only lasts 60 seconds
+                ttl    = min(ttl, 60.0)
+
+            suppressed = False
+            if action is not None:
+                if (target is not None and
+                        not self.bot.claim_action(target, ttl)):
+                    suppressed = True
+                    METRICS.inc("bismite_actions_suppressed_total")
                 else:
-                    when += random.uniform(1,10)
+                    await self._mask_act(mask_id, d.type, action)
 
-                heappush(self.delayed_send, (when, action))
-            else:
-                await self.send_raw(action)
+            now       = int(time())
+            reference = f"{nick}!{user.user}@{user.host} {user.real}"
+            for match_id in match_ids:
+                self.bot.stage_put(
+                    "record", self.bot.hit_queue, (match_id, now, reference)
+                )
 
             mtype_str = mtype_tostring(d.type)
-            output = (f"MASK: {mtype_str} mask {mask_id} "
-                f"{nick}!{user.user}@{user.host} {user.real}"
+            sample = (f"{nick}!{user.user}@{user.host} {user.real}"
                 f" [{oper_reason}]")
+            channels: List[str] = []
             if (mtype_action == MaskAction.EXCLUDE and
                     len(types) == 1):
                 # we matched an EXCLUDE but no other types.
                 # do not log
                 pass
             elif d.type & MaskModifier.QUIET:
-                await self._verbose(output)
+                channels.append(self._config.verbose)
             elif not d.type & MaskModifier.SILENT:
-                await self._verbose(output)
+                channels.append(self._config.verbose)
                 if not self._config.channel == self._config.verbose:
-                    await self.report(output)
+                    channels.append(self._config.channel)
+
+            if (self.degraded and
+                    not self._config.channel == self._config.verbose):
+                channels = [
+                    c for c in channels if not c == self._config.verbose
+                ]
+
+            if channels:
+                self.bot.stage_put("report", self.bot.report_queue,
+                    (self, channels, mask_id, mtype_str, sample, suppressed))
+
+        if self.bot.shadow_masks:
+            self.bot.stage_put("shadow", self.bot.shadow_queue, references)
+
+        self._idle_reset()
+
+    async def reports_send(self,
+            channels:   List[str],
+            mask_id:    int,
+            mtype_str:  str,
+            sample:     str,
+            suppressed: bool):
+
+        for channel in channels:
+            # past the report rate, hits are summarised per mask instead
+            if self.reports.add(
+                    channel, mask_id, mtype_str, sample, suppressed):
+                if suppressed:
+                    sample += " (duplicate action suppressed)"
+                await self._report(
+                    channel, f"MASK: {mtype_str} mask {mask_id} {sample}"
+                )
+
+    def _degrade(self):
+        now  = monotonic()
+        span = now - self.to_check[0][0]
+        self.degraded        = True
+        self.degraded_checks = 0
+        self._degraded_at    = now
+        # connects/s that got us here. we recover once it's halved
+        self._degraded_rate  = len(self.to_check) / max(span, 0.1)
+        self._degraded_told  = False
+
+    async def degraded_update(self):
+        now  = monotonic()
+        rate = ((self.connects - self._rate_connects)
+            / max(now - self._rate_at, 1e-3))
+        self._rate_connects = self.connects
+        self._rate_at       = now
+
+        if not self.degraded:
+            pass
+        elif not self._degraded_told:
+            self._degraded_told = True
+            await self.report(
+                f"DEGRADED: {self._config.to_check_max} connections waiting"
+                f" for WHOIS ({self._degraded_rate:.0f}/s). checking new"
+                " connections without WHOIS, sampling history and not"
+                " sending verbose reports"
+            )
+        elif rate < self._degraded_rate / 2:
+            self.degraded = False
+            elapsed = to_pretty_time(int(now - self._degraded_at)) or "0s"
+            await self.report(
+                f"DEGRADED: recovered after {elapsed} ({rate:.0f}/s),"
+                f" {self.degraded_checks} connections checked without WHOIS"
+            )
 
     async def _report(self, channel: str, message: str):
-        await self.send(build("PRIVMSG", [channel, message]))
+        # reports must never hold up action lines
+        await self.send(build("PRIVMSG", [channel, message]), SendPriority.LOW)
     async def report(self, message: str):
         await self._report(self._config.channel, message)
     async def _verbose(self, message: str):
@@ -294,14 +594,7 @@ class Server(BaseServer):
 
     async def line_read(self, line: Line):
         if line.command == RPL_WELCOME:
-            self.active_masks.clear()
-            self._reasons.clear()
-            # load and compile all masks/reason templates
-            for mask_id, mask in await self._database.masks.list_enabled():
-                self.active_masks[mask_id] = mask_compile(mask)
-
-            for key, value in await self._database.reasons.list():
-                self._reasons[key] = value
+            await self.bot.masks_load()
 
             oper_name, oper_pass, oper_file = self._config.oper
             await self._oper_up(oper_name, oper_pass, oper_file)
@@ -328,7 +621,7 @@ class Server(BaseServer):
         elif line.command == RPL_ENDOFWHOIS:
             nick = line.params[1]
             if (self._nick_change_whois and
-                    self._nick_change_whois[0] == nick):
+                    self._nick_change_whois[0][1] == nick):
 
                 self._nick_change_whois.popleft()
 
@@ -378,19 +671,47 @@ class Server(BaseServer):
                     # remote i-line spoof
                     ip = None
 
+                claim = (self.casefold(nick), user, host, ip)
+                if (len(self.bot.servers) > 1 and
+                        not self.bot.claim(claim, CONNECT_CLAIM_TTL)):
+                    # another of our servers is already checking this one
+                    return
+
+                self.connects += 1
                 user = User(user, host, real, ip)
-                # we hold on to nick:User of all connected users
+                # we hold on to nick:User of all connected users. a nick we
+                # missed the exit of goes to the (fresh) end, not where it was
+                stale = self._users.pop(nick, None)
+                if stale is not None:
+                    stale.connected = False
                 self._users[nick] = user
-                # send a WHOIS to check accountname
-                await self.send(build("WHOIS", [nick]))
+                if len(self._users) > self._config.users_max:
+                    # don't wait for reap_users to notice
+                    del self._users[next(iter(self._users))]
+
+                if self.degraded:
+                    # no time to wait on WHOIS; match on what the connect
+                    # notice told us
+                    self.degraded_checks += 1
+                    await self.mask_check(nick, user, Event.CONNECT)
+                else:
+                    # send a WHOIS to check accountname
+                    await self.send(build("WHOIS", [nick]))
 
-                self.to_check.append((monotonic(), nick, user))
+                    self.to_check.append((monotonic(), nick, user))
+                    if len(self.to_check) >= self._config.to_check_max:
+                        self._degrade()
 
             elif p_cliexit is not None:
                 nick = p_cliexit.group("nick")
+                self._forget_oper(nick)
 
                 if nick in self._users:
                     user = self._users.pop(nick)
+                    # a quick reconnect is a new connection
+                    self.bot.unclaim(
+                        (self.casefold(nick), user.user, user.host, user.ip)
+                    )
                     # .connected is used to not match clients that disconnect
                     # too quickly (e.g. due to OPM murder)
                     user.connected = False
@@ -398,21 +719,29 @@ class Server(BaseServer):
             elif p_clinick is not None:
                 old_nick = p_clinick.group("old")
                 new_nick = p_clinick.group("new")
+                self._forget_oper(old_nick)
+                self._forget_oper(new_nick)
 
                 if old_nick in self._users:
+                    # re-inserted so `_users` stays ordered by `.seen`
                     user = self._users.pop(old_nick)
+                    user.seen = monotonic()
+                    self._users.pop(new_nick, None)
                     self._users[new_nick] = user
-                    # refresh what we think this user's account is
-                    self._nick_change_whois.append(new_nick)
-                    user.account = None
-                    await self.send(build("WHOIS", [new_nick]))
+                    if not self.degraded:
+                        # refresh what we think this user's account is
+                        self._nick_change_whois.append(
+                            (monotonic(), new_nick)
+                        )
+                        user.account = None
+                        await self.send(build("WHOIS", [new_nick]))
 
     async def cmd(self,
             hostmask: Hostmask,
             command:  str,
             args:     str):
 
-        opername = await self._get_oper(hostmask.nickname)
+        opername = await self._get_oper(hostmask)
         if opername is not None:
             attrib  = f"cmd_{command}"
             if hasattr(self, attrib):
@@ -420,7 +749,14 @@ class Server(BaseServer):
                 func   = getattr(self, attrib)
                 outs: List[str] = []
                 try:
-                    outs.extend(await func(caller, args))
+                    if (getattr(func, "_mutates", False) and
+                            not self.bot.owns_masks):
+                        outs.append(
+                            "masks are managed by the bismite instance that"
+                            " owns the database"
+                        )
+                    else:
+                        outs.extend(await func(caller, args))
                 except UsageError as e:
                     outs.append(str(e))
                     for usage in func._usage:
@@ -444,21 +780,193 @@ class Server(BaseServer):
             last_hit = f", last hit {last_hit} ago"
 
         mtype_str = mtype_tostring(details.type)
+        velocity  = ""
+        if details.velocity is not None:
+            velocity = f" @{details.velocity}"
+        if details.shadow:
+            velocity += " (shadow)"
         return (
             f"{str(mask_id).rjust(3)}:"
             f" \x02{mask}\x02"
             f" ({details.hits} hits{last_hit})"
-            f" \x02{mtype_str}\x02"
+            f" \x02{mtype_str}\x02{velocity}"
             f" [{details.reason or ''}]"
         )
 
-    @usage("<mask-id>")
+    def _pack(self,
+            target:  str,
+            entries: List[str]
+            ) -> List[str]:
+
+        # as many entries to a line as fit in what's left of 512 bytes
+        prefix = (
+            f":{self.nickname}!{self.username or 'x'*10}"
+            f"@{self.hostname or 'x'*63} NOTICE {target} :"
+        )
+        budget = 510 - len(prefix.encode("utf8"))
+        sep    = len(PACK_SEPARATOR)
+
+        outs: List[str] = []
+        line = ""
+        size = 0
+        for entry in entries:
+            entry  = entry.strip()
+            length = len(entry.encode("utf8"))
+            if line and size + sep + length <= budget:
+                line += PACK_SEPARATOR + entry
+                size += sep + length
+            else:
+                if line:
+                    outs.append(line)
+                line = entry
+                size = length
+        if line:
+            outs.append(line)
+        return outs
+
+    def _paged(self,
+            target:  str,
+            entries: List[str],
+            page:    int,
+            total:   int,
+            summary: str,
+            command: str
+            ) -> List[str]:
+
+        # `entries` is just this page's
+        return self._pack(target, entries) + _page_footer(
+            page, total, summary, command
+        )
+
+    async def _dump(self,
+            filename: str,
+            entries:  List[str]
+            ) -> List[str]:
+
+        path = self._data_path(filename)
+        text = "".join(
+            format_strip(entry.strip()) + "\n" for entry in entries
+        )
+        try:
+            # never over something that's already there
+            await asyncio.get_running_loop().run_in_executor(
+                None, _write_new, path, text
+            )
+        except FileExistsError:
+            return [f"{path} already exists"]
+        except OSError as e:
+            return [f"couldn't write {path}: {e.strerror}"]
+        return [f"{len(entries)} lines written to {path}"]
+
+    async def cmd_userstats(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        count = len(self._users)
+        if not count:
+            return ["no users tracked"]
+
+        # sizing every user record would stall us on a big table, so estimate
+        # from a sample of them
+        sample = list(self._users.values())[:1000]
+        sample_size = 0
+        for user in sample:
+            sample_size += sys.getsizeof(user)
+            for value in (user.user, user.host, user.real, user.ip):
+                if value is not None:
+                    sample_size += sys.getsizeof(value)
+
+        size  = sys.getsizeof(self._users)
+        size += (sample_size // len(sample)) * count
+        oldest = next(iter(self._users.values()))
+        oldest_s = to_pretty_time(int(monotonic() - oldest.seen)) or "0s"
+
+        return [
+            f"{count} users tracked"
+            f" (max {self._config.users_max},"
+            f" reaped after {to_pretty_time(self._config.users_maxage)})",
+            f"approx. {size // 1024} KiB, oldest seen {oldest_s} ago"
+        ]
+
+    @usage("<seconds> [<count>]")
+    async def cmd_profile(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        args = sargs.split()
+        if not args:
+            raise UsageError("please provide a number of seconds")
+        elif not all(arg.isdigit() for arg in args[:2]):
+            raise UsageError("that's not a number")
+
+        seconds = int(args[0])
+        count   = int(args[1]) if len(args) > 1 else 10
+        if not 0 < seconds <= 300:
+            raise UsageError("seconds must be between 1 and 300")
+        elif not 0 < count <= PROFILE_COUNT_MAX:
+            raise UsageError(
+                f"count must be between 1 and {PROFILE_COUNT_MAX}"
+            )
+        elif self.bot.profiling:
+            return ["a profile is already running"]
+
+        # don't hold up reading lines (or the profile) until it's done
+        self.bot.profiling = True
+        asyncio.create_task(self._profile(caller.nick, seconds, count))
+        return [f"profiling for {seconds}s"]
+
+    async def _profile(self,
+            nick:    str,
+            seconds: int,
+            count:   int):
+
+        try:
+            outs = await self._profile_run(seconds, count)
+        except Exception as e:
+            traceback.print_exc()
+            outs = [f"profile failed: {type(e).__name__}: {str(e)}"]
+        for out in outs:
+            await self.send(build("NOTICE", [nick, out]))
+
+    async def _profile_run(self,
+            seconds: int,
+            count:   int
+            ) -> List[str]:
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            self.bot.profiling = False
+
+        filename = path_join(
+            dirname(self._config.database),
+            f"bismite-profile-{int(time())}.pstats"
+        )
+        profile.dump_stats(filename)
+
+        stats = pstats.Stats(profile).sort_stats(pstats.SortKey.CUMULATIVE)
+        outs  = [f"profile written to {filename}, top {count} by cumulative:"]
+        for func in stats.fcn_list[:count]:
+            filepath, line, name = func
+            _, calls, own, cumulative, _ = stats.stats[func]
+            outs.append(
+                f" {cumulative:.3f}s ({own:.3f}s own, {calls} calls)"
+                f" {basename(filepath)}:{line} {name}"
+            )
+        return outs
+
+    @usage("<mask-id> [-all [-page <n>|-file <name>]|-hits]")
     async def cmd_getmask(self,
             caller: Caller,
             sargs:  str
             ) -> List[str]:
 
-        args = sargs.split(None, 2)
+        args, page, filename = _page_args(sargs.split())
         if not args:
             raise UsageError("please provide a mask id")
         elif not args[0].isdigit():
@@ -468,13 +976,29 @@ class Server(BaseServer):
         if not await self._database.masks.has_id(mask_id):
             return [f"unknown mask id {mask_id}"]
         mask, d = await self._database.masks.get(mask_id)
-        changes = await self._database.changes.get(mask_id)
 
         outs = [
             self._mask_format(mask_id, mask, d),
             "\x02changes:\x02"
         ]
 
+        if "-hits" in args:
+            if mask_id in self.bot.mask_recent:
+                recent = list(self.bot.mask_recent[mask_id])
+            else:
+                recent = await self._database.hits.get(
+                    mask_id, MASK_RECENT_HITS
+                )
+            outs[1] = "\x02recent hits:\x02"
+            for ts, reference in reversed(recent):
+                tss = datetime.utcfromtimestamp(ts).isoformat()
+                outs.append(f" {tss} {reference}")
+            if not recent:
+                outs.append(" none")
+            return outs
+
+        changes = await self._database.changes.get(mask_id)
+        entries: List[str] = []
         change_max = len(changes) if "-all" in args else 10
         for who_nick, who_oper, ts, change in changes[-change_max:]:
             if who_oper is not None:
@@ -482,16 +1006,25 @@ class Server(BaseServer):
             else:
                 who = f"{who_nick}"
             tss = datetime.utcfromtimestamp(ts).isoformat()
-            outs.append(
+            entries.append(
                 f" {tss}"
                 f" by \x02{who}\x02:"
                 f" {change}"
             )
-        return outs
 
-    @usage("/<regex>/ <public reason>[|<oper reason>]")
-    @usage('"<string>" <public reason>[|<oper reason>]')
-    @usage('%<glob>% <public reason>[|<oper reason>]')
+        if filename is not None:
+            return await self._dump(filename, outs + entries)
+        elif not "-all" in args:
+            return outs + entries
+        return outs + self._paged(
+            caller.nick, _page_slice(entries, page), page, len(entries),
+            f"{len(entries)} changes", f"GETMASK {mask_id} -all"
+        )
+
+    @usage("/<regex>/ [-shadow] <public reason>[|<oper reason>]")
+    @usage('"<string>" [-shadow] <public reason>[|<oper reason>]')
+    @usage('%<glob>% [-shadow] <public reason>[|<oper reason>]')
+    @mutates
     async def cmd_addmask(self,
             caller: Caller,
             args:   str
@@ -499,42 +1032,140 @@ class Server(BaseServer):
 
         try:
             mask, args = mask_token(args)
-            cmask      = mask_compile(mask)
+            cmask      = self.bot.mask_compile(mask)
         except ValueError as e:
             raise UsageError(f"syntax error: {str(e)}")
         except re.error as e:
             return [f"regex compilation error: {str(e)}"]
 
+        shadow = False
+        flag, _, rest = args.strip().partition(" ")
+        if flag == "-shadow":
+            shadow = True
+            args   = rest.lstrip()
+
         if not args:
             raise UsageError("please provide a mask reason")
 
         reason = args
-        mask_id = await self._database.masks.add(mask, reason)
+        mask_id = await self._database.masks.add(mask, reason, shadow)
         await self._database.changes.add(
-            mask_id, caller.source, caller.oper, "add"
+            mask_id, caller.source, caller.oper,
+            "add shadow" if shadow else "add"
         )
-        self.active_masks[mask_id] = cmask
+        self.bot.mask_update(mask_id, mask, True, shadow)
+        await self.bot.mask_changed(mask_id)
 
         # check/warn about how many users this will hit
         matches = 0
         samples = 0
         for i in range(self._config.history):
-            if i == len(self._recent_masks):
+            if i == len(self.bot.recent_masks):
                 break
             samples += 1
-            recent_masks = self._recent_masks[i]
+            recent_masks = self.bot.recent_masks[i]
             for recent_mask in recent_masks:
                 if cmask.search(recent_mask):
                     matches += 1
                     # only breaks one level of `for`
                     break
 
+        shadow_s = " as a shadow mask" if shadow else ""
         return [
-            f"added {mask_id} "
+            f"added {mask_id}{shadow_s} "
             f"(hits {matches} out of last {samples} users)"
         ]
 
+    @usage("[<id>] [-page <n>|-file <name>]")
+    async def cmd_listshadow(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        args, page, filename = _page_args(sargs.split())
+        if args and not args[0].isdigit():
+            raise UsageError("that's not an id/number")
+
+        now = monotonic()
+        # one per mask: its line, then its samples if we're showing them
+        groups: List[List[str]] = []
+        for mask_id, stats in list(self.bot.shadow_stats.items()):
+            if args and not mask_id == int(args[0]):
+                continue
+            mask, d = await self._database.masks.get(mask_id)
+            since   = to_pretty_time(int(now - stats.since)) or "0s"
+            group   = [
+                f"{self._mask_format(mask_id, mask, d)}"
+                f" would have hit {stats.hits} in last {since}"
+            ]
+            if args:
+                for sample in stats.samples:
+                    sample = sample.replace("\n", "#")
+                    group.append(f" {sample}")
+            groups.append(group)
+
+        if filename is not None:
+            return await self._dump(
+                filename, [line for group in groups for line in group]
+            )
+        elif args and not groups:
+            return [f"{args[0]} isn't an enabled shadow mask"]
+
+        # paged by mask, and samples are never packed together with
+        # anything else
+        outs: List[str] = []
+        headers: List[str] = []
+        for group in groups[(page-1)*PAGE_SIZE:page*PAGE_SIZE]:
+            headers.append(group[0])
+            if len(group) > 1:
+                outs.extend(self._pack(caller.nick, headers))
+                outs.extend(group[1:])
+                headers = []
+        outs.extend(self._pack(caller.nick, headers))
+
+        return outs + _page_footer(
+            page, len(groups), f"{len(groups)} shadow masks",
+            f"LISTSHADOW {' '.join(args)}".rstrip()
+        )
+
+    @usage("<mask-id>")
+    @mutates
+    async def cmd_promotemask(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        args = sargs.split(None, 1)
+        if not args:
+            raise UsageError("please provide a mask id")
+        elif not args[0].isdigit():
+            raise UsageError("that's not an id/number")
+
+        mask_id = int(args[0])
+        if not await self._database.masks.has_id(mask_id):
+            return [f"unknown mask id {mask_id}"]
+
+        mask, d = await self._database.masks.get(mask_id)
+        if not d.shadow:
+            return [f"{mask} isn't a shadow mask"]
+
+        stats = self.bot.shadow_stats.get(mask_id, None)
+        await self._database.masks.set_shadow(mask_id, False)
+        await self._database.changes.add(
+            mask_id, caller.source, caller.oper, "promote"
+        )
+        self.bot.mask_update(mask_id, mask, bool(d.enabled), False)
+        await self.bot.mask_changed(mask_id)
+
+        mtype_str = mtype_tostring(d.type)
+        hits_s    = "" if stats is None else f", would have hit {stats.hits}"
+        who = f"{caller.nick} ({caller.oper})"
+        log = f"{who} PROMOTEMASK: {mtype_str} \x02{mask}\x02{hits_s}"
+        await self.send(build("PRIVMSG", [self._config.channel, log]))
+        return [f"{mask} is now live as \x02{mtype_str}\x02"]
+
     @usage("<mask-id>")
+    @mutates
     async def cmd_togglemask(self,
             caller: Caller,
             sargs:  str
@@ -557,13 +1188,8 @@ class Server(BaseServer):
             mask_id, caller.source, caller.oper, enabled_s
         )
 
-        if enabled:
-            self.active_masks[mask_id] = mask_compile(mask)
-            self.active_masks = OrderedDict(
-                sorted(self.active_masks.items())
-            )
-        else:
-            del self.active_masks[mask_id]
+        self.bot.mask_update(mask_id, mask, enabled, d.shadow)
+        await self.bot.mask_changed(mask_id)
 
         mtype_str = mtype_tostring(d.type)
         who = f"{caller.nick} ({caller.oper})"
@@ -574,7 +1200,8 @@ class Server(BaseServer):
         await self.send(build("PRIVMSG", [self._config.channel, out]))
         return [f"{mtype_str} mask {mask_id} {enabled_s}"]
 
-    @usage("<id> <type>")
+    @usage("<id> [~|+<expiry>] [@<count>/<window>[:<key>]|@off] [<type>]")
+    @mutates
     async def cmd_setmask(self,
             caller: Caller,
             sargs:  str
@@ -609,10 +1236,29 @@ class Server(BaseServer):
                 await self._database.changes.add(
                     mask_id, caller.source, caller.oper, f"expire {timespec}"
                 )
+                await self.bot.mask_changed(mask_id)
                 outs.append(f"{mask} expiry set to {timespec}")
             else:
                 raise UsageError("expiry must be in format +1w2d/~1w2d")
 
+        if args[1:] and args[1].startswith("@"):
+            spec = args.pop(1)[1:]
+            if spec == "off":
+                velocity: Optional[str] = None
+            else:
+                try:
+                    velocity = velocity_tostring(velocity_parse(spec))
+                except ValueError as e:
+                    raise UsageError(str(e))
+
+            await self._database.masks.set_velocity(mask_id, velocity)
+            await self._database.changes.add(
+                mask_id, caller.source, caller.oper,
+                f"velocity {velocity or 'off'}"
+            )
+            await self.bot.mask_changed(mask_id)
+            outs.append(f"{mask} velocity set to {velocity or 'off'}")
+
         if not args[1:]:
             return outs
 
@@ -629,6 +1275,7 @@ class Server(BaseServer):
         await self._database.changes.add(
             mask_id, caller.source, caller.oper, f"type {mtype_str}"
         )
+        await self.bot.mask_changed(mask_id)
 
         # *p*revious mtype_str
         pmtype_str = mtype_tostring(d.type)
@@ -640,20 +1287,240 @@ class Server(BaseServer):
         outs.insert(0, out)
         return outs
 
+    @usage("[-page <n>|-file <name>]")
     async def cmd_listmask(self,
             caller: Caller,
             sargs:  str
             ) -> List[str]:
 
-        outs: List[str] = []
-        for mask_id, _ in self.active_masks.items():
-            mask, d = await self._database.masks.get(mask_id)
-            outs.append(self._mask_format(mask_id, mask, d))
+        _, page, filename = _page_args(sargs.split())
+
+        entries: List[str] = []
+        for mask_id, mask, d in await self._database.masks.list_details():
+            if mask_id in self.bot.active_masks:
+                entries.append(self._mask_format(mask_id, mask, d))
+
+        if filename is not None:
+            return await self._dump(filename, entries)
+        return self._paged(
+            caller.nick, _page_slice(entries, page), page, len(entries),
+            f"{len(entries)} active masks", "LISTMASK"
+        )
+
+    @usage("[<text>] [-type <action>] [-enabled|-disabled] [-oper <name>]"
+        " [-newer <time>] [-older <time>] [-page <n>|-file <name>]")
+    async def cmd_findmask(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        words, page, filename = _page_args(sargs.split())
+        text:  List[str] = []
+        action:  Optional[int]  = None
+        enabled: Optional[bool] = None
+        oper:    Optional[str]  = None
+        newer:   Optional[int]  = None
+        older:   Optional[int]  = None
+        # what to search for again for the next page
+        query = " ".join(words)
+        while words:
+            word = words.pop(0)
+            if   word in {"-enabled", "-disabled"}:
+                enabled = word == "-enabled"
+            elif word in {"-type", "-oper", "-newer", "-older"}:
+                if not words:
+                    raise UsageError(f"{word} needs a value")
+                value = words.pop(0)
+                if   word == "-type":
+                    try:
+                        action = mtype_getaction(mtype_fromstring(value)).value
+                    except ValueError as e:
+                        raise UsageError(str(e))
+                elif word == "-oper":
+                    oper = value
+                else:
+                    seconds = from_pretty_time(value)
+                    if not seconds:
+                        raise UsageError(f"{word} must be in format 1w2d")
+                    if word == "-newer":
+                        newer = int(time()) - seconds
+                    else:
+                        older = int(time()) - seconds
+            else:
+                text.append(word)
+
+        if text and len(" ".join(text)) < 3:
+            raise UsageError("search text must be at least 3 characters")
+
+        search = (" ".join(text) or None, action, enabled, oper, newer, older)
+        if filename is not None:
+            # everything; -1 is no limit to sqlite
+            _, masks = await self._database.masks.find(*search, -1, 0)
+            return await self._dump(filename, [
+                self._mask_format(mask_id, mask, d)
+                for mask_id, mask, d in masks
+            ])
+
+        total, masks = await self._database.masks.find(
+            *search, PAGE_SIZE, (page-1)*PAGE_SIZE
+        )
+        return self._paged(
+            caller.nick,
+            [self._mask_format(mask_id, mask, d) for mask_id, mask, d in masks],
+            page, total, f"{total} masks found", f"FINDMASK {query}".rstrip()
+        )
+
+    @usage("[-run] [-page <n>|-file <name>]")
+    async def cmd_auditmasks(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        args, page, filename = _page_args(sargs.split())
+        if "-run" in args:
+            if self.bot.auditing:
+                return ["an audit is already running"]
+            # before the task starts, so a second -run sees it
+            self.bot.auditing = True
+            asyncio.create_task(self._audit(caller.nick))
+            return [
+                f"auditing {len(self.bot.active_masks)} masks against last"
+                f" {len(self.bot.recent_masks)} users"
+            ]
+
+        audit = self.bot.audit
+        if audit is None:
+            running = " (one is running now)" if self.bot.auditing else ""
+            return [f"no audit has been run yet{running}"]
+
+        entries: List[str] = []
+        for mask_id in audit.dead:
+            entries.append(f"\x02{mask_id}\x02 dead")
+        for mask_id, by, hits in audit.subsumed:
+            entries.append(
+                f"\x02{mask_id}\x02 subsumed by \x02{by}\x02 ({hits} hits)"
+            )
+        for a, b, both, share in audit.overlaps:
+            entries.append(
+                f"\x02{a}\x02 and \x02{b}\x02 overlap {share:.0%}"
+                f" ({both} hits)"
+            )
+
+        if filename is not None:
+            return await self._dump(filename, entries)
+        ago = to_pretty_time(int(time() - audit.when)) or "0s"
+        return self._paged(
+            caller.nick, _page_slice(entries, page), page, len(entries),
+            f"{len(audit.dead)} dead, {len(audit.subsumed)} subsumed and"
+            f" {len(audit.overlaps)} overlapping masks of {audit.masks},"
+            f" against last {audit.samples} users {ago} ago",
+            "AUDITMASKS"
+        )
+
+    async def _audit(self, nick: str):
+        try:
+            audit = await self.bot.masks_audit()
+        except Exception as e:
+            traceback.print_exc()
+            out = f"audit failed: {type(e).__name__}: {str(e)}"
+        else:
+            out = (
+                f"audit done: {len(audit.dead)} dead, {len(audit.subsumed)}"
+                f" subsumed, {len(audit.overlaps)} overlapping."
+                " see AUDITMASKS"
+            )
+        await self.send(build("NOTICE", [nick, out]))
+
+    def _data_path(self, filename: str) -> str:
+        # only ever files next to the database, and never the database
+        if not filename or "/" in filename or filename.startswith("."):
+            raise UsageError("please provide a file name (not a path)")
+        path = path_join(dirname(self._config.database), filename)
+        if path.startswith(self._config.database):
+            # including its -wal and -journal files
+            raise UsageError("that's the mask database")
+        return path
+
+    @usage("<file>")
+    @mutates
+    async def cmd_importmasks(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
 
-        outs.append(f"{len(outs)} active masks")
+        filename = self._data_path(sargs.strip())
+        loop     = asyncio.get_running_loop()
+        try:
+            imports, errors = await loop.run_in_executor(
+                None, masks_read, filename
+            )
+        except OSError as e:
+            return [f"couldn't read {filename}: {e.strerror}"]
+
+        cmasks, compile_errors = await masks_compile(imports)
+        errors += compile_errors
+        if errors:
+            outs = [f" {error}" for error in errors[:10]]
+            if len(errors) > 10:
+                outs.append(f" (and {len(errors)-10} more)")
+            outs.insert(0, f"{len(errors)} errors, nothing imported:")
+            return outs
+        elif not imports:
+            return [f"no masks in {filename}"]
+
+        mask_ids = await self._database.masks.add_many(
+            [
+                (m.mask, m.type, m.enabled, m.expire, m.reason, m.velocity,
+                    m.shadow)
+                for m in imports
+            ],
+            caller.source, caller.oper
+        )
+        await self.bot.masks_imported([
+            (mask_id, m.mask, cmask, m.enabled, m.shadow)
+            for mask_id, m, cmask in zip(mask_ids, imports, cmasks)
+        ])
+
+        who = f"{caller.nick} ({caller.oper})"
+        log = f"{who} IMPORTMASKS: {len(mask_ids)} masks from {filename}"
+        await self.send(build("PRIVMSG", [self._config.channel, log]))
+
+        # check/warn about how many users these will hit, all in one pass
+        history = list(self.bot.recent_masks)
+        hit, per_mask = await loop.run_in_executor(
+            None, history_scan, cmasks, history
+        )
+        outs = [
+            f"imported {len(mask_ids)} masks ({mask_ids[0]}-{mask_ids[-1]})"
+            f" (hits {hit} out of last {len(history)} users)"
+        ]
+        if per_mask:
+            outs.append("most hits: " + ", ".join(
+                f"{mask_ids[i]} ({hits})"
+                for i, hits in per_mask.most_common(5)
+            ))
         return outs
 
+    @usage("<file>")
+    async def cmd_exportmasks(self,
+            caller: Caller,
+            sargs:  str
+            ) -> List[str]:
+
+        filename = self._data_path(sargs.strip())
+        masks    = await self._database.masks.list_details(disabled=True)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, masks_write, filename, masks
+            )
+        except FileExistsError:
+            return [f"{filename} already exists"]
+        except OSError as e:
+            return [f"couldn't write {filename}: {e.strerror}"]
+        return [f"exported {len(masks)} masks to {filename}"]
+
     @usage("<alias> <text ...>")
+    @mutates
     async def cmd_addreason(self,
             caller: Caller,
             sargs:  str
@@ -668,10 +1535,12 @@ class Server(BaseServer):
             return [f"reason alias \x02${alias}\x02 already exists"]
 
         await self._database.reasons.add(alias, args[1])
-        self._reasons[alias] = args[1]
+        self.bot.reason_update(alias, args[1])
+        self.bot.reason_changed(alias, args[1])
         return [f"added reason alias \x02${alias}\x02"]
 
     @usage("<alias>")
+    @mutates
     async def cmd_delreason(self,
             caller: Caller,
             sargs:  str
@@ -684,21 +1553,31 @@ class Server(BaseServer):
         alias = args[0].lower()
         if await self._database.reasons.has_key(alias):
             await self._database.reasons.delete(alias)
-            del self._reasons[alias]
+            self.bot.reason_update(alias, None)
+            self.bot.reason_changed(alias, None)
             return [f"deleted reason alias \x02${alias}\x02"]
         else:
             return [f"the reason alias \x02${alias}\x02 does not exist"]
 
+    @usage("[-page <n>|-file <name>]")
     async def cmd_listreason(self,
             caller: Caller,
             args:   str
             ) -> List[str]:
 
-        args = args.split()
-        outs: List[str] = []
-        for key, value in self._reasons.items():
-            outs.append(f"\x02${key}\x02: {value}")
-        return outs or ["no reason aliases"]
+        _, page, filename = _page_args(args.split())
+        entries: List[str] = []
+        for key, value in self.bot.reasons.items():
+            entries.append(f"\x02${key}\x02: {value}")
+
+        if filename is not None:
+            return await self._dump(filename, entries)
+        elif not entries:
+            return ["no reason aliases"]
+        return self._paged(
+            caller.nick, _page_slice(entries, page), page, len(entries),
+            f"{len(entries)} reason aliases", "LISTREASON"
+        )
 
     @usage("/<pattern>/")
     async def cmd_testmask(self,
@@ -721,10 +1600,10 @@ class Server(BaseServer):
         samples = 0
         matches: List[str] = []
         for i in range(self._config.history):
-            if i == len(self._recent_masks):
+            if i == len(self.bot.recent_masks):
                 break
             samples += 1
-            recent_masks = self._recent_masks[i]
+            recent_masks = self.bot.recent_masks[i]
             for recent_mask in recent_masks:
                 if cmask.search(recent_mask):
                     matches.append(recent_mask)
@@ -760,11 +1639,55 @@ class Server(BaseServer):
 
         return [f"\x02{mask}\x02 compiles to: {cmask.pattern}"]
 
+    def metrics(self) -> Iterable[Sample]:
+        now    = monotonic()
+        labels = {"server": self.name}
+        def _age(ts: Optional[float]) -> float:
+            return 0.0 if ts is None else max(0.0, now - ts)
+
+        yield ("bismite_degraded", labels, int(self.degraded))
+        yield ("bismite_to_check_depth", labels, len(self.to_check))
+        yield ("bismite_to_check_age_seconds", labels,
+            _age(self.to_check[0][0] if self.to_check else None))
+        # how overdue the next delayed action is
+        yield ("bismite_delayed_send_depth", labels, len(self.delayed_send))
+        yield ("bismite_delayed_send_age_seconds", labels,
+            _age(self.delayed_send[0][0] if self.delayed_send else None))
+        yield ("bismite_nick_change_whois_depth", labels,
+            len(self._nick_change_whois))
+        yield ("bismite_nick_change_whois_age_seconds", labels,
+            _age(self._nick_change_whois[0][0]
+                if self._nick_change_whois else None))
+        yield ("bismite_users", labels, len(self._users))
+
     def line_preread(self, line: Line):
+        METRICS.inc("bismite_lines_read_total", server=self.name)
         print(f"< {line.format()}")
     def line_presend(self, line: Line):
+        METRICS.inc("bismite_lines_sent_total", server=self.name)
         print(f"> {line.format()}")
 
+def _claim(
+        claims: TOrderedDict[Any, float],
+        key:    Any,
+        ttl:    float
+        ) -> bool:
+
+    # claims are (near enough) ordered by expiry, so the expired ones are
+    # all at the front
+    now = monotonic()
+    while claims:
+        first, expire = next(iter(claims.items()))
+        if expire > now:
+            break
+        del claims[first]
+
+    if claims.get(key, now) > now:
+        return False
+    claims.pop(key, None)
+    claims[key] = now + ttl
+    return True
+
 class Bot(BaseBot):
     def __init__(self,
             config:   Config,
@@ -773,5 +1696,411 @@ class Bot(BaseBot):
         self._config   = config
         self._database = database
 
+        # one mask engine, shared by every server we're connected to
+        self.recent_masks:  Deque[List[str]] = deque()
+        self.active_masks:  TOrderedDict[int, Mask] = OrderedDict()
+        # active_masks, split in to those we search for in each connection's
+        # `nick!user@host real` and those we look its IP up in
+        self.mask_regexes:  List[Tuple[int, Pattern]] = []
+        self.mask_cidrs     = CIDRTable([])
+        # enabled masks that are still being compiled after a (re)connect
+        self.masks_pending: Dict[int, str] = {}
+        self._compiling:    Optional[asyncio.Task] = None
+        self.reasons:       Dict[str, str] = {}
+        # (template, mask id, mask reason): compiled template
+        self.templates:     Dict[Tuple[str, int, str], Template] = {}
+        # mask text (including flags): compiled mask
+        self.mask_cache:    Dict[str, Mask] = {}
+        # mask id: mask text that didn't compile, so it isn't tried again
+        # until the text changes
+        self.masks_failed:  Dict[int, str] = {}
+        # enabled mask id: details, so actions don't wait on the database
+        self.mask_details:  Dict[int, MaskDetails] = {}
+        # recent matches of velocity masks
+        self.velocity       = VelocityCounter(config.velocity_keys)
+        # mask id: its last few hits, as (time, `nick!user@host real`)
+        self.mask_recent:   Dict[int, Deque[Tuple[int, str]]] = {}
+        # candidate masks, matched off to the side of active_masks
+        self.shadow_masks:  Dict[int, Mask] = {}
+        self.shadow_stats:  Dict[int, ShadowStats] = {}
+
+        # later stages of mask_check
+        # (mask id, time, `nick!user@host real`)
+        self.hit_queue:    asyncio.Queue[Tuple[int, int, str]] = (
+            asyncio.Queue(STAGE_QUEUE_SIZE)
+        )
+        self.report_queue: asyncio.Queue[Tuple[Any, ...]] = asyncio.Queue(
+            STAGE_QUEUE_SIZE
+        )
+        self.cluster_queue: asyncio.Queue[Tuple[str, User]] = asyncio.Queue(
+            STAGE_QUEUE_SIZE
+        )
+        self.shadow_queue:  asyncio.Queue[List[str]] = asyncio.Queue(
+            STAGE_QUEUE_SIZE
+        )
+        self.clusters = ClusterDetector(
+            CLUSTER_SKETCH_SIZE, config.cluster_threshold
+        )
+
+        # (casefolded nick, user, host, ip): when our claim on checking that
+        # connection runs out
+        self._claims: TOrderedDict[
+            Tuple[str, str, str, Optional[str]], float
+        ] = OrderedDict()
+        # (action, target): when we'd send that action for that target again
+        self._actions: TOrderedDict[Tuple[str, str], float] = OrderedDict()
+        self.profiling = False
+        # the last mask audit, and whether one's running now
+        self.audit: Optional[Audit] = None
+        self.auditing = False
+
+        # sharing masks with other bismite instances, if we are
+        self.sync: Optional[Union[SyncOwner, SyncSubscriber]] = None
+
+    @property
+    def owns_masks(self) -> bool:
+        return not isinstance(self.sync, SyncSubscriber)
+
+    def stage_put(self,
+            stage: str,
+            queue: asyncio.Queue,
+            item:  Any):
+
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            METRICS.inc("bismite_stage_shed_total", stage=stage)
+
+    async def mask_get(self, mask_id: int) -> MaskDetails:
+        if not mask_id in self.mask_details:
+            # e.g. matched while its details were being (re)loaded
+            _, self.mask_details[mask_id] = await self._database.masks.get(
+                mask_id
+            )
+        return self.mask_details[mask_id]
+
+    async def mask_hit(self, mask_id: int, hits: int=1):
+        if isinstance(self.sync, SyncSubscriber):
+            # the owner writes these for us, in batches
+            self.sync.hit(mask_id, hits)
+        else:
+            await self._database.masks.hit(mask_id, hits)
+
+    async def mask_changed(self, mask_id: int):
+        mask, d = await self._database.masks.get(mask_id)
+        if d.enabled:
+            self.mask_details[mask_id] = d
+        else:
+            self.mask_details.pop(mask_id, None)
+
+        if isinstance(self.sync, SyncOwner):
+            self.sync.broadcast({
+                "kind":    "mask",
+                "id":      mask_id,
+                "mask":    mask,
+                "type":    d.type,
+                "enabled": bool(d.enabled),
+                "shadow":  bool(d.shadow)
+            })
+
+    async def masks_imported(self,
+            # (mask id, mask, compiled mask, enabled, shadow)
+            masks: List[Tuple[int, str, Mask, bool, bool]]):
+
+        for mask_id, mask, cmask, enabled, shadow in masks:
+            self.mask_cache.setdefault(mask, cmask)
+            self.mask_update(mask_id, mask, enabled, shadow, sort=False)
+        self.masks_sort()
+
+        mask_ids = {mask_id for mask_id, *_ in masks}
+        for mask_id, _, d in await self._database.masks.list_details():
+            if mask_id in mask_ids:
+                self.mask_details[mask_id] = d
+
+        if isinstance(self.sync, SyncOwner):
+            # one refresh rather than an event per mask
+            self.sync.broadcast({"kind": "refresh"})
+
+    async def masks_audit(self, chunk_size: int=1000) -> Audit:
+        # replay history against every active mask, a chunk at a time off
+        # the event loop, and see which masks never hit or only ever hit
+        # what others do
+        self.auditing = True
+        try:
+            loop    = asyncio.get_running_loop()
+            masks   = list(self.active_masks.items())
+            history = list(self.recent_masks)
+            cohits  = CoHits()
+            for i in range(0, len(history), chunk_size):
+                await loop.run_in_executor(
+                    None, cohits.add, masks, history[i:i+chunk_size]
+                )
+            self.audit = audit_report(
+                [mask_id for mask_id, _ in masks], cohits
+            )
+        finally:
+            self.auditing = False
+        return self.audit
+
+    def reason_changed(self, key: str, value: Optional[str]):
+        if isinstance(self.sync, SyncOwner):
+            self.sync.broadcast({"kind": "reason", "key": key, "value": value})
+
+    async def hits_record(self, hits: List[Tuple[int, int, str]]):
+        counts: Dict[int, int] = {}
+        for mask_id, ts, reference in hits:
+            counts[mask_id] = counts.get(mask_id, 0) + 1
+            if not mask_id in self.mask_recent:
+                # carry on from where we were before a restart
+                recent = await self._database.hits.get(
+                    mask_id, MASK_RECENT_HITS
+                )
+                self.mask_recent[mask_id] = deque(
+                    recent, maxlen=MASK_RECENT_HITS
+                )
+            self.mask_recent[mask_id].append((ts, sys.intern(reference)))
+
+        for mask_id, count in counts.items():
+            await self.mask_hit(mask_id, count)
+        if self.owns_masks:
+            await self._database.hits.add(hits, MASK_RECENT_HITS)
+
+    def shadow_check(self, references: List[str]):
+        for mask_id, cmask in list(self.shadow_masks.items()):
+            for ref in references:
+                if cmask.search(ref):
+                    stats = self.shadow_stats[mask_id]
+                    stats.hits += 1
+                    stats.samples.append(ref)
+                    self.stage_put("record", self.hit_queue,
+                        (mask_id, int(time()), ref.partition("\n")[2]))
+                    break
+
+    def mask_update(self,
+            mask_id: int,
+            mask:    str,
+            enabled: bool,
+            shadow:  bool=False,
+            sort:    bool=True):
+
+        # with `sort=False`, the caller calls masks_sort() once it's done
+        self.masks_failed.pop(mask_id, None)
+        if enabled:
+            try:
+                cmask = self.mask_compile(mask)
+            except (ValueError, re.error):
+                traceback.print_exc()
+                self.masks_failed[mask_id] = mask
+                return
+
+        if enabled and shadow:
+            if not self.shadow_masks.get(mask_id, None) is cmask:
+                self.shadow_masks[mask_id] = cmask
+                self.shadow_stats[mask_id] = ShadowStats()
+            # no longer (or not yet) live
+            enabled = False
+        else:
+            self.shadow_masks.pop(mask_id, None)
+            self.shadow_stats.pop(mask_id, None)
+
+        if enabled:
+            self.masks_pending.pop(mask_id, None)
+            if not self.active_masks.get(mask_id, None) is cmask:
+                self.active_masks[mask_id] = cmask
+                if sort:
+                    self.masks_sort()
+        else:
+            self.masks_pending.pop(mask_id, None)
+            if self.active_masks.pop(mask_id, None) is not None and sort:
+                self.masks_sort()
+
+    def reason_update(self, key: str, value: Optional[str]):
+        if value is None:
+            self.reasons.pop(key, None)
+        else:
+            self.reasons[key] = value
+        self.templates.clear()
+
     def create_server(self, name: str):
         return Server(self, name, self._config, self._database)
+
+    def claim(self,
+            connection: Tuple[str, str, str, Optional[str]],
+            ttl:        float
+            ) -> bool:
+
+        # with several servers on the same network, each of them sees the
+        # same (far) connections. the first server to see one checks it
+        return _claim(self._claims, connection, ttl)
+
+    def claim_action(self, target: Tuple[str, str], ttl: float) -> bool:
+        # shared by all servers; a k-line from any of them is network-wide
+        return _claim(self._actions, target, ttl)
+
+    def unclaim(self, connection: Tuple[str, str, str, Optional[str]]):
+        self._claims.pop(connection, None)
+
+    def mask_compile(self, mask: str) -> Mask:
+        # compiled masks outlive reconnects, which get a new Server object
+        if not mask in self.mask_cache:
+            self.mask_cache[mask] = mask_compile(mask)
+        return self.mask_cache[mask]
+
+    def masks_compile_pending(self):
+        for mask_id, mask in list(self.masks_pending.items()):
+            del self.masks_pending[mask_id]
+            try:
+                self.active_masks[mask_id] = self.mask_compile(mask)
+            except (ValueError, re.error):
+                traceback.print_exc()
+        self.masks_sort()
+
+    def masks_sort(self):
+        self.active_masks = OrderedDict(sorted(self.active_masks.items()))
+        regexes: List[Tuple[int, Pattern]] = []
+        cidrs:   List[Tuple[int, CIDRMask]] = []
+        for mask_id, cmask in self.active_masks.items():
+            if isinstance(cmask, CIDRMask):
+                cidrs.append((mask_id, cmask))
+            else:
+                regexes.append((mask_id, cmask))
+        self.mask_regexes = regexes
+        self.mask_cidrs   = CIDRTable(cidrs)
+
+    async def _masks_compile(self, chunk_size: int=100):
+        loop    = asyncio.get_running_loop()
+        pending = list(self.masks_pending.items())
+        for i in range(0, len(pending), chunk_size):
+            chunk    = pending[i:i+chunk_size]
+            compiled = await loop.run_in_executor(
+                None, _masks_compile, [mask for _, mask in chunk]
+            )
+            for (mask_id, mask), cmask in zip(chunk, compiled):
+                if not self.masks_pending.get(mask_id, None) == mask:
+                    # compiled on demand or disabled while we were busy
+                    continue
+                del self.masks_pending[mask_id]
+                if cmask is not None:
+                    self.mask_cache[mask] = cmask
+                    self.active_masks[mask_id] = cmask
+                else:
+                    self.masks_failed[mask_id] = mask
+        self.masks_sort()
+
+    async def masks_load(self):
+        # load all masks/reason templates. masks we've compiled before (e.g.
+        # before a reconnect) are used straight away, the rest are compiled
+        # off the event loop so we can oper up and start matching sooner
+        masks   = await self._database.masks.list_details()
+        reasons = await self._database.reasons.list()
+
+        # other servers may be matching against these, so nothing is
+        # cleared until we're ready to refill it
+        active_masks:  TOrderedDict[int, Mask] = OrderedDict()
+        masks_pending: Dict[int, str] = {}
+        for mask_id, mask, d in masks:
+            if d.shadow:
+                # few and off the hot path, so just compile them now
+                self.mask_update(mask_id, mask, True, True)
+            elif mask in self.mask_cache:
+                active_masks[mask_id] = self.mask_cache[mask]
+            else:
+                masks_pending[mask_id] = mask
+
+        self.active_masks  = active_masks
+        self.masks_pending = masks_pending
+        self.masks_sort()
+        shadows = {mask_id for mask_id, _, d in masks if d.shadow}
+        for mask_id in list(self.shadow_masks.keys()):
+            if not mask_id in shadows:
+                self.mask_update(mask_id, "", False)
+        self.mask_details  = {mask_id: d for mask_id, _, d in masks}
+        self.reasons       = dict(reasons)
+        self.templates.clear()
+
+        if self.masks_pending:
+            self._compiling = asyncio.create_task(self._masks_compile())
+
+    async def masks_wait(self):
+        while self.masks_pending:
+            compiling = self._compiling
+            if compiling is None or compiling.done():
+                # nothing's compiling what's left, e.g. it failed
+                self.masks_compile_pending()
+                break
+            try:
+                await asyncio.shield(compiling)
+            except Exception:
+                traceback.print_exc()
+
+    async def masks_refresh(self) -> Tuple[int, int]:
+        # apply what's changed in the database since we last loaded it, e.g.
+        # by hand with the sqlite3 CLI. only masks whose text has changed are
+        # compiled again
+        details = await self._database.masks.list_details()
+        masks   = {
+            mask_id: mask for mask_id, mask, d in details if not d.shadow
+        }
+        shadows = {mask_id: mask for mask_id, mask, d in details if d.shadow}
+        reasons = dict(await self._database.reasons.list())
+        self.mask_details = {mask_id: d for mask_id, _, d in details}
+
+        masks_changed = 0
+        for mask_id, mask in list(self.masks_failed.items()):
+            if not (masks.get(mask_id, None) == mask or
+                    shadows.get(mask_id, None) == mask):
+                # gone, disabled or changed; try again if it's still there
+                del self.masks_failed[mask_id]
+        for mask_id in list(self.active_masks.keys()):
+            if not mask_id in masks:
+                self.mask_update(mask_id, "", False, sort=False)
+                masks_changed += 1
+        for mask_id in list(self.shadow_masks.keys()):
+            if not mask_id in shadows:
+                self.mask_update(mask_id, "", False, sort=False)
+                masks_changed += 1
+        for mask_id, mask in shadows.items():
+            if self.masks_failed.get(mask_id, None) == mask:
+                continue
+            cmask = self.shadow_masks.get(mask_id, None)
+            if cmask is None or not self.mask_cache.get(mask, None) is cmask:
+                self.mask_update(mask_id, mask, True, True, sort=False)
+                if not mask_id in self.masks_failed:
+                    masks_changed += 1
+        for mask_id, mask in list(self.masks_pending.items()):
+            if not masks.get(mask_id, None) == mask:
+                del self.masks_pending[mask_id]
+        for mask_id, mask in masks.items():
+            if (self.masks_pending.get(mask_id, None) == mask or
+                    self.masks_failed.get(mask_id, None) == mask):
+                continue
+            cmask = self.active_masks.get(mask_id, None)
+            if cmask is None or not self.mask_cache.get(mask, None) is cmask:
+                self.mask_update(mask_id, mask, True, sort=False)
+                if not mask_id in self.masks_failed:
+                    masks_changed += 1
+        if masks_changed:
+            self.masks_sort()
+
+        reasons_changed = 0
+        for key in set(self.reasons) | set(reasons):
+            if not self.reasons.get(key, None) == reasons.get(key, None):
+                self.reason_update(key, reasons.get(key, None))
+                reasons_changed += 1
+
+        return (masks_changed, reasons_changed)
+
+    def metrics(self) -> Iterable[Sample]:
+        yield ("bismite_recent_masks", {}, len(self.recent_masks))
+        yield ("bismite_active_masks", {}, len(self.active_masks))
+        yield ("bismite_velocity_keys", {}, len(self.velocity))
+        yield ("bismite_stage_queue", {"stage": "record"},
+            self.hit_queue.qsize())
+        yield ("bismite_stage_queue", {"stage": "report"},
+            self.report_queue.qsize())
+        yield ("bismite_stage_queue", {"stage": "clusters"},
+            self.cluster_queue.qsize())
+        yield ("bismite_stage_queue", {"stage": "shadow"},
+            self.shadow_queue.qsize())
+        for server in list(self.servers.values()):
+            yield from server.metrics()
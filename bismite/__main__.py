@@ -4,30 +4,51 @@ from argparse import ArgumentParser
 from ircrobots import ConnectionParams, SASLUserPass
 
 from .         import Bot
+from .sync     import SyncOwner, SyncSubscriber
 from .config   import Config, load as config_load
 from .database import Database
-from .timers   import delayed_send, delayed_check, expire_masks
+from .metrics  import METRICS, serve as metrics_serve
+from .timers   import all_timers
 
 async def main(config: Config):
     db  = Database(config.database)
     bot = Bot(config, db)
+    # subscribers too; one may start before the owner has ever run on this
+    # database, and we read the new columns straight away
+    await db.setup()
 
     sasl_user, sasl_pass = config.sasl
 
-    params = ConnectionParams.from_hoststring(config.nickname, config.server)
-    params.username = config.username
-    params.realname = config.realname
-    params.password = config.password
-    params.sasl = SASLUserPass(sasl_user, sasl_pass)
-    params.autojoin = [config.channel, config.verbose]
-
-    await bot.add_server("irc", params)
-    await asyncio.wait([
-        asyncio.create_task(delayed_send(bot)),
-        asyncio.create_task(delayed_check(bot)),
-        asyncio.create_task(expire_masks(bot, db)),
-        asyncio.create_task(bot.run())
-    ])
+    for i, server in enumerate(config.servers):
+        params = ConnectionParams.from_hoststring(config.nickname, server)
+        params.username = config.username
+        params.realname = config.realname
+        params.password = config.password
+        params.sasl = SASLUserPass(sasl_user, sasl_pass)
+        params.autojoin = [config.channel, config.verbose]
+
+        name = "irc" if i == 0 else f"irc{i+1}"
+        await bot.add_server(name, params)
+    timers = all_timers(
+        bot, db,
+        lag_threshold=config.lag_threshold,
+        reload_interval=config.reload_interval,
+        cluster_window=config.cluster_window,
+        audit_interval=config.audit_interval
+    )
+    tasks  = [asyncio.create_task(timer) for timer in timers]
+    if config.metrics is not None:
+        METRICS.collector(bot.metrics)
+        tasks.append(asyncio.create_task(metrics_serve(config.metrics)))
+    if config.sync is not None:
+        role, path = config.sync
+        if role == "owner":
+            bot.sync = SyncOwner(path, db)
+        else:
+            bot.sync = SyncSubscriber(path, bot)
+        tasks.append(asyncio.create_task(bot.sync.run()))
+
+    await asyncio.wait(tasks + [asyncio.create_task(bot.run())])
 
 if __name__ == "__main__":
     parser = ArgumentParser()
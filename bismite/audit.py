@@ -0,0 +1,83 @@
+from collections import Counter
+from dataclasses import dataclass
+from itertools   import combinations
+from time        import time
+from typing      import List, Sequence, Tuple
+
+from .common import Mask
+
+class CoHits(object):
+    # for a sample of recent connections, how many each mask hit and how many
+    # each pair of masks both hit. most connections hit no masks, and those
+    # that do rarely hit more than two, so the pairs stay sparse
+    def __init__(self):
+        self.samples = 0
+        self.hits:  Counter[int] = Counter()
+        self.pairs: Counter[Tuple[int, int]] = Counter()
+
+    def add(self,
+            masks:   Sequence[Tuple[int, Mask]],
+            history: Sequence[List[str]]):
+
+        # run in an executor thread, away from the event loop
+        for references in history:
+            self.samples += 1
+            hit = [
+                mask_id for mask_id, cmask in masks
+                if any(cmask.search(reference) for reference in references)
+            ]
+            if hit:
+                self.hits.update(hit)
+                # `masks` are in id order, so pairs are (lower, higher)
+                self.pairs.update(combinations(hit, 2))
+
+@dataclass
+class Audit(object):
+    when:     float
+    masks:    int
+    samples:  int
+    # mask id
+    dead:     List[int]
+    # (mask id, the mask id it's subsumed by, hits)
+    subsumed: List[Tuple[int, int, int]]
+    # (mask id, mask id, hits by both, share of all their hits)
+    overlaps: List[Tuple[int, int, int, float]]
+
+def audit_report(
+        mask_ids: Sequence[int],
+        cohits:   CoHits,
+        min_hits: int=3,
+        overlap:  float=0.5
+        ) -> Audit:
+
+    hits = cohits.hits
+    dead = [mask_id for mask_id in mask_ids if not hits[mask_id]]
+
+    subsumed: List[Tuple[int, int, int]] = []
+    seen = set()
+    pairs = cohits.pairs.most_common()
+    # most shared hits first, so a mask is put down to the mask that covers
+    # the most of it
+    for (a, b), both in pairs:
+        # a is older. when they hit exactly the same, b is the redundant one
+        if   hits[b] == both and hits[b] >= min_hits and not b in seen:
+            subsumed.append((b, a, both))
+            seen.add(b)
+        elif hits[a] == both and hits[a] >= min_hits and not a in seen:
+            subsumed.append((a, b, both))
+            seen.add(a)
+
+    # a subsumed mask is already reported; it'd overlap with everything its
+    # subsumer does
+    overlaps: List[Tuple[int, int, int, float]] = []
+    for (a, b), both in pairs:
+        if a in seen or b in seen:
+            continue
+        share = both / (hits[a] + hits[b] - both)
+        if share >= overlap:
+            overlaps.append((a, b, both, share))
+
+    overlaps.sort(key=lambda o: o[3], reverse=True)
+    return Audit(
+        time(), len(mask_ids), cohits.samples, dead, subsumed, overlaps
+    )
@@ -0,0 +1,365 @@
+import asyncio, os, resource, sqlite3, sys, tempfile, threading
+from argparse import ArgumentParser
+from random   import Random
+from time     import monotonic
+from typing   import Dict, List, Optional, Set
+
+import yaml
+from irctokens import tokenise
+from ircrobots import ConnectionParams
+
+from .         import Bot
+from .common   import MaskAction
+from .config   import Config, load as config_load
+from .database import Database
+from .timers   import all_timers
+
+ROOT        = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_NAME = "bench.bismite"
+
+class FakeIRCd(object):
+    # just enough of an ircd for bismite: registration, OPER, JOIN/WHO/WHOIS
+    # replies, and once bismite has set its snomask, a flood of connect, exit
+    # and nick change snotes. runs on its own thread and event loop, so it
+    # doesn't compete with bismite for the loop we're measuring
+    def __init__(self,
+            rate:       int,
+            duration:   float,
+            bad_ratio:  float,
+            exit_ratio: float,
+            nick_ratio: float,
+            lethal:     int,
+            seed:       int):
+
+        self._rate       = rate
+        self._duration   = duration
+        self._bad_ratio  = bad_ratio
+        self._exit_ratio = exit_ratio
+        self._nick_ratio = nick_ratio
+        self._lethal     = lethal
+        self._random     = Random(seed)
+
+        self.port = 0
+        self.ready      = threading.Event()
+        self.flood_done = threading.Event()
+
+        self.sent  = 0
+        self.lines_in = 0
+        # ip: when the connect snote for a to-be-banned user was sent
+        self.expected: Dict[str, float] = {}
+        self.exited:   Set[str] = set()
+        # ip: when a ban for that ip was seen
+        self.actions:  Dict[str, float] = {}
+        self.unexpected = 0
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def _send(self, writer: asyncio.StreamWriter, line: str):
+        writer.write(f"{line}\r\n".encode("utf8"))
+
+    async def _client(self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter):
+
+        nick: Optional[str] = None
+        user_seen   = False
+        cap_done    = False
+        registered  = False
+        flood: Optional["asyncio.Task[None]"] = None
+
+        while True:
+            data = await reader.readline()
+            if not data:
+                break
+            self.lines_in += 1
+            line = tokenise(data.decode("utf8").rstrip("\r\n"))
+            cmd  = line.command
+
+            if cmd == "CAP":
+                if line.params[0] == "LS":
+                    self._send(writer, f":{SERVER_NAME} CAP * LS :")
+                elif line.params[0] == "END":
+                    cap_done = True
+            elif cmd == "NICK":
+                if registered:
+                    self._send(writer, f":{nick}!bench@bench NICK {line.params[0]}")
+                nick = line.params[0]
+            elif cmd == "USER":
+                user_seen = True
+            elif cmd == "PING":
+                self._send(writer,
+                    f":{SERVER_NAME} PONG {SERVER_NAME} :{line.params[0]}")
+            elif cmd == "OPER":
+                self._send(writer,
+                    f":{SERVER_NAME} 381 {nick} :You are now an IRC operator")
+            elif cmd == "MODE":
+                if (line.params[0] == nick and
+                        flood is None and
+                        "s" in "".join(line.params[1:])):
+                    flood = asyncio.create_task(self._flood(writer))
+            elif cmd == "JOIN":
+                for chan in line.params[0].split(","):
+                    self._send(writer, f":{nick}!bench@bench JOIN {chan}")
+                    self._send(writer,
+                        f":{SERVER_NAME} 366 {nick} {chan} :End of /NAMES list.")
+            elif cmd == "WHO":
+                self._send(writer,
+                    f":{SERVER_NAME} 315 {nick} {line.params[0]} :End of /WHO list.")
+            elif cmd == "WHOIS":
+                self._send(writer,
+                    f":{SERVER_NAME} 318 {nick} {line.params[0]} :End of /WHOIS list.")
+            elif cmd == "KLINE":
+                now = monotonic()
+                _, _, ip = line.params[1].partition("@")
+                if ip in self.expected and not ip in self.actions:
+                    self.actions[ip] = now
+                else:
+                    self.unexpected += 1
+
+            if (not registered and
+                    cap_done and user_seen and nick is not None):
+                registered = True
+                self._send(writer, f":{SERVER_NAME} 001 {nick} :Welcome")
+                self._send(writer, f":{SERVER_NAME} 376 {nick} :End of /MOTD")
+
+            await writer.drain()
+
+    def _connect(self, writer: asyncio.StreamWriter, n: int):
+        ip = f"10.{(n>>16)&255}.{(n>>8)&255}.{n&255}"
+        if self._random.random() < self._bad_ratio:
+            nick = f"bot{n%self._lethal}x{n}"
+            real = "spam spam spam"
+            self.expected[ip] = monotonic()
+        else:
+            nick = f"user{n}"
+            real = f"regular user {n}"
+        user = f"~u{n}"
+        host = f"host-{n}.example.com"
+
+        self._send(writer,
+            f":{SERVER_NAME} NOTICE * :*** Notice -- Client connecting:"
+            f" {nick} ({user}@{host}) [{ip}] {{users}} [{real}]"
+        )
+        if self._random.random() < self._exit_ratio:
+            self._send(writer,
+                f":{SERVER_NAME} NOTICE * :*** Notice -- Client exiting:"
+                f" {nick} ({user}@{host}) [Quit: bye] [{ip}]"
+            )
+            self.exited.add(ip)
+        elif self._random.random() < self._nick_ratio:
+            self._send(writer,
+                f":{SERVER_NAME} NOTICE * :*** Notice -- Nick change:"
+                f" From {nick} to {nick}_ [{user}@{host}]"
+            )
+
+    async def _flood(self, writer: asyncio.StreamWriter):
+        per_second = self._rate / 60
+        start = monotonic()
+        while True:
+            elapsed = monotonic() - start
+            if elapsed >= self._duration:
+                break
+            due = int(elapsed * per_second)
+            while self.sent < due:
+                self._connect(writer, self.sent)
+                self.sent += 1
+            await writer.drain()
+            await asyncio.sleep(0.01)
+        self.flood_done.set()
+
+def _make_database(path: str, masks: int, lethal: int):
+    db = sqlite3.connect(path)
+    with open(os.path.join(ROOT, "make-database.sql")) as schema:
+        db.executescript(schema.read())
+
+    rows = []
+    for i in range(lethal):
+        rows.append((f"/^bot{i}x\\d+!/", MaskAction.LETHAL.value))
+    # a mix of mask kinds that won't match anything, but still cost us time
+    for i in range(max(0, masks-lethal)):
+        kind = i % 3
+        if kind == 0:
+            rows.append((f"/^spam{i}[a-z]{{3}}\\d+!/i", MaskAction.WARN.value))
+        elif kind == 1:
+            rows.append((f'"spam{i}@"', MaskAction.WARN.value))
+        else:
+            rows.append((f"%spam{i}!*@*%", MaskAction.WARN.value))
+
+    db.executemany("""
+        INSERT INTO masks (mask, type, enabled, reason, hits, last_hit)
+        VALUES (?, ?, 1, 'bench', 0, 0)
+    """, rows)
+    db.commit()
+    db.close()
+
+def _make_config(
+        config_path: str,
+        database:    str,
+        port:        int,
+        workdir:     str
+        ) -> Config:
+
+    with open(config_path) as file:
+        config_yaml = yaml.safe_load(file.read())
+
+    config_yaml.update({
+        "server":   f"127.0.0.1:{port}",
+        "nickname": "bismite",
+        "password": None,
+        "antiidle": False,
+        "database": database,
+        "oper":     {"name": "bench", "pass": "bench"},
+    })
+    bench_config = os.path.join(workdir, "config.yaml")
+    with open(bench_config, "w") as file:
+        file.write(yaml.safe_dump(config_yaml))
+    return config_load(bench_config)
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index  = min(len(values)-1, int(len(values) * percent / 100))
+    return values[index]
+
+def _times(values: List[float]) -> str:
+    return ", ".join([
+        f"p50 {_percentile(values, 50)*1000:.1f}ms",
+        f"p90 {_percentile(values, 90)*1000:.1f}ms",
+        f"p99 {_percentile(values, 99)*1000:.1f}ms",
+        f"max {max(values or [0.0])*1000:.1f}ms"
+    ])
+
+async def _loop_lag(samples: List[float], interval: float=0.01):
+    while True:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, monotonic() - start - interval))
+
+async def bench(
+        config_path: str,
+        rate:        int,
+        duration:    float,
+        masks:       int,
+        lethal:      int,
+        bad_ratio:   float,
+        exit_ratio:  float,
+        nick_ratio:  float,
+        check_delay: int,
+        drain:       float,
+        seed:        int):
+
+    # the generated database and config are thrown away afterwards
+    with tempfile.TemporaryDirectory(prefix="bismite-bench-") as workdir:
+        database = os.path.join(workdir, "masks.db")
+        _make_database(database, masks, lethal)
+
+        ircd = FakeIRCd(
+            rate, duration, bad_ratio, exit_ratio, nick_ratio, lethal, seed
+        )
+        threading.Thread(target=ircd.run, daemon=True).start()
+        ircd.ready.wait()
+
+        config = _make_config(config_path, database, ircd.port, workdir)
+        db     = Database(config.database)
+        bot    = Bot(config, db)
+
+        params = ConnectionParams.from_hoststring(
+            config.nickname, config.servers[0]
+        )
+        params.autojoin = [config.channel, config.verbose]
+        await bot.add_server("irc", params)
+
+        lag: List[float] = []
+        timers = all_timers(
+            bot, db, check_delay, config.lag_threshold, config.reload_interval,
+            config.cluster_window, config.audit_interval
+        )
+        tasks  = [asyncio.create_task(timer) for timer in timers]
+        tasks.append(asyncio.create_task(bot.run()))
+        tasks.append(asyncio.create_task(_loop_lag(lag)))
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, ircd.flood_done.wait)
+        await asyncio.sleep(check_delay + drain)
+
+        server = list(bot.servers.values())[0]
+        users  = len(server._users)
+        # connect notices bismite got to, WHOIS or not
+        read   = server.connects
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        expected  = {ip for ip in ircd.expected if not ip in ircd.exited}
+        latencies = [
+            ircd.actions[ip] - ircd.expected[ip]
+            for ip in expected if ip in ircd.actions
+        ]
+        missed = len(expected - set(ircd.actions))
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        print(f"connections: {ircd.sent} in {duration:.0f}s"
+            f" ({ircd.sent/duration*60:.0f}/min),"
+            f" {len(ircd.exited)} exited early", file=sys.stderr)
+        print(f"throughput:  {read/duration:.0f} connects read/s,"
+            f" {len(ircd.actions)/duration:.0f} actions/s", file=sys.stderr)
+        print(f"actions:     {len(ircd.actions)} of {len(expected)} expected,"
+            f" {missed} missed, {ircd.unexpected} unexpected", file=sys.stderr)
+        print(f"latency:     {_times(latencies)}"
+            f" (connect notice to action, check delay {check_delay}s)",
+            file=sys.stderr)
+        print(f"loop lag:    {_times(lag)}", file=sys.stderr)
+        print(f"memory:      max rss {max_rss//1024} MiB, {users} users tracked",
+            file=sys.stderr)
+        print(f"masks:       {masks} ({lethal} lethal)", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="measure bismite against a local fake ircd's snote flood"
+    )
+    parser.add_argument("--config",
+        default=os.path.join(ROOT, "config.example.yaml"),
+        help="config to take snote regexes and settings from")
+    parser.add_argument("--rate", type=int, default=10_000,
+        help="connections per minute")
+    parser.add_argument("--duration", type=float, default=30.0,
+        help="seconds to flood for")
+    parser.add_argument("--masks", type=int, default=1000,
+        help="masks in the generated database")
+    parser.add_argument("--lethal", type=int, default=50,
+        help="how many of those masks are LETHAL")
+    parser.add_argument("--bad", type=float, default=0.1,
+        help="ratio of connections that match a LETHAL mask")
+    parser.add_argument("--exits", type=float, default=0.05,
+        help="ratio of connections that exit straight away")
+    parser.add_argument("--nicks", type=float, default=0.05,
+        help="ratio of connections that change nick straight away")
+    parser.add_argument("--check-delay", type=int, default=0,
+        help="seconds bismite waits for WHOIS before checking a connection")
+    parser.add_argument("--drain", type=float, default=5.0,
+        help="seconds to wait for stragglers after the flood")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    asyncio.run(bench(
+        args.config,
+        args.rate,
+        args.duration,
+        args.masks,
+        max(1, args.lethal),
+        args.bad,
+        args.exits,
+        args.nicks,
+        args.check_delay,
+        args.drain,
+        args.seed
+    ))
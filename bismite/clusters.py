@@ -0,0 +1,167 @@
+import re, traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+from ipaddress   import ip_address
+from typing      import Callable, Dict, List, Optional, Tuple
+from typing      import OrderedDict as TOrderedDict
+
+from .common import User, mask_compile
+
+RE_NICK_RUN = re.compile(r"[a-z]+|[A-Z]+|[0-9]+|.")
+
+def nick_shape(nick: str) -> str:
+    # "abc123" -> "[a-z]{3}[0-9]{3}"
+    shape: List[str] = []
+    for run in RE_NICK_RUN.findall(nick):
+        if   run[0].islower() and run[0].isascii():
+            shape.append(f"[a-z]{{{len(run)}}}")
+        elif run[0].isupper() and run[0].isascii():
+            shape.append(f"[A-Z]{{{len(run)}}}")
+        elif run[0].isdigit() and run[0].isascii():
+            shape.append(f"[0-9]{{{len(run)}}}")
+        else:
+            shape.append(re.escape(run))
+    return "".join(shape)
+
+def _host_suffix(user: User) -> str:
+    if user.ip is not None and user.host == user.ip:
+        if ":" in user.ip:
+            try:
+                # /64, from the uncompressed address so e.g. 2001:db8::1
+                # and 2001:db8:0:0:1::1 land together
+                return ip_address(user.ip).exploded[:19]
+            except ValueError:
+                pass
+        return user.ip.rpartition(".")[0]
+    return ".".join(user.host.split(".")[-2:])
+
+def _mask_escape(s: str) -> str:
+    return re.escape(s).replace("/", "\\/")
+
+def _suggest_host(suffix: str) -> str:
+    if suffix.count(".") == 2 and suffix.replace(".", "").isdigit():
+        return f"<{suffix}.0/24>"
+    elif ":" in suffix:
+        return f"<{suffix}::/64>"
+    return f"/@(?:\\S*\\.)?{_mask_escape(suffix)} /"
+
+# field: (what to count, what addmask we'd suggest for a spike of it)
+Field  = Tuple[Callable[[str, User], str], Callable[[str], str]]
+FIELDS: Dict[str, Field] = {
+    "realname": (
+        lambda nick, user: user.real,
+        lambda real: f"/^\\S+ {_mask_escape(real)}$/"
+    ),
+    "ident": (
+        lambda nick, user: user.user,
+        lambda ident: f"/^[^!]+!{_mask_escape(ident)}@/"
+    ),
+    "host": (
+        lambda nick, user: _host_suffix(user),
+        _suggest_host
+    ),
+    "nick shape": (
+        lambda nick, user: nick_shape(nick),
+        lambda shape: f"/^{shape}!/"
+    )
+}
+
+class FrequentItems(object):
+    # misra-gries: at most `size` counters. when a new value turns up and
+    # we're full, every counter goes down by one (and those at 0 go). any
+    # value seen more than n/size times is guaranteed to still be here, and
+    # counts are at most n/size short. decrements are paid for by the
+    # increments before them, so it's O(1) per value, amortised
+    def __init__(self, size: int):
+        self._size  = size
+        self.counts: Dict[str, int] = {}
+
+    def add(self, value: str):
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < self._size:
+            counts[value] = 1
+        else:
+            for key in list(counts):
+                counts[key] -= 1
+                if counts[key] == 0:
+                    del counts[key]
+
+    def top(self) -> List[Tuple[str, int]]:
+        return sorted(
+            self.counts.items(), key=lambda c: c[1], reverse=True
+        )
+
+@dataclass
+class Spike(object):
+    field:    str
+    value:    str
+    count:    int
+    baseline: int
+    mask:     Optional[str]
+
+class ClusterDetector(object):
+    # counts the most common values of each of FIELDS over a window of
+    # connections, and calls out those that have jumped since the last window
+    def __init__(self,
+            size:      int,
+            threshold: int,
+            factor:    float=4.0,
+            quiet:     int=10):
+
+        self._size      = size
+        self._threshold = threshold
+        self._factor    = factor
+        # windows to wait before calling out the same value again
+        self._quiet     = quiet
+
+        self._current:  Dict[str, FrequentItems] = {}
+        self._previous: Dict[str, FrequentItems] = {}
+        for field in FIELDS:
+            self._current[field]  = FrequentItems(size)
+            self._previous[field] = FrequentItems(size)
+
+        self._windows = 0
+        # (field, value): window we last called it out in
+        self._alerted: TOrderedDict[Tuple[str, str], int] = OrderedDict()
+
+    def add(self, nick: str, user: User):
+        for field, (value, _) in FIELDS.items():
+            self._current[field].add(value(nick, user))
+
+    def flush(self) -> List[Spike]:
+        self._windows += 1
+        spikes: List[Spike] = []
+        for field, (_, suggest) in FIELDS.items():
+            current  = self._current[field]
+            previous = self._previous[field]
+            # the first window has nothing to compare against
+            for value, count in current.top() if self._windows > 1 else []:
+                if count < self._threshold:
+                    break
+                baseline = previous.counts.get(value, 0)
+                if count < max(baseline, 1) * self._factor:
+                    continue
+
+                key = (field, value)
+                if self._alerted.get(key, -self._quiet) > (
+                        self._windows - self._quiet):
+                    continue
+                self._alerted.pop(key, None)
+                self._alerted[key] = self._windows
+                if len(self._alerted) > self._size:
+                    self._alerted.popitem(last=False)
+
+                mask = suggest(value)
+                try:
+                    mask_compile(mask)
+                except (ValueError, re.error):
+                    # better no suggestion than one ADDMASK won't take
+                    traceback.print_exc()
+                    mask = None
+                spikes.append(Spike(field, value, count, baseline, mask))
+
+            self._previous[field] = current
+            self._current[field]  = FrequentItems(self._size)
+        return spikes
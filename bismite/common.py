@@ -1,23 +1,47 @@
 import re, string
-from dataclasses import dataclass
+from sys         import intern
+from time        import monotonic
 from enum        import Enum, IntEnum, IntFlag
 from fnmatch     import translate as glob_translate
-from typing      import Any, Dict, Pattern, Optional, Set, Tuple
+from ipaddress   import ip_address, ip_network, IPv4Network, IPv6Network
+from typing      import (Any, Dict, List, Pattern, Optional, Set, Tuple,
+    Union)
 
 from ircrobots.formatting import strip as format_strip
 
 FLAG_CHARS = set("AaiNnZz^$")
+# flags that only make sense for masks matched against text
+FLAG_CHARS_TEXT = set("i^$")
 
-@dataclass
 class User(object):
-    user: str
-    host: str
-    real: str
-    ip: Optional[str]
-    account: Optional[str] = None
-    secure: bool = False
-
-    connected: bool = True
+    # we keep one of these per connected client, so keep them small. botnets
+    # tend to reuse idents, hosts and realnames, so share those strings
+    __slots__ = (
+        "user", "host", "real", "ip", "account", "secure", "connected", "seen"
+    )
+
+    def __init__(self,
+            user:    str,
+            host:    str,
+            real:    str,
+            ip:      Optional[str],
+            account: Optional[str]=None,
+            secure:  bool=False):
+
+        self.user      = intern(user)
+        self.host      = intern(host)
+        self.real      = intern(real)
+        self.ip        = ip
+        self.account   = account
+        self.secure    = secure
+
+        self.connected = True
+        # last time we saw this user connect or change nick
+        self.seen      = monotonic()
+
+    def __repr__(self) -> str:
+        return (f"User({self.user!r}, {self.host!r}, {self.real!r},"
+            f" {self.ip!r}, {self.account!r}, {self.secure!r})")
 
 class MaskAction(IntEnum):
     KILL    = 0
@@ -121,6 +145,22 @@ def _find_unescaped(s: str, c: str):
     else:
         return -1
 
+def _delim_close(s: str) -> str:
+    # "<" is closed by ">" only when what's between them is an IP range.
+    # before CIDR masks, "<" was a regex delimiter like any other, closed by
+    # another "<", and masks like that still need to mean what they did
+    delim = s[0]
+    if delim == "<":
+        end = _find_unescaped(s, ">")
+        if not end == -1:
+            try:
+                ip_network(s[1:end-1], strict=False)
+            except ValueError:
+                pass
+            else:
+                return ">"
+    return delim
+
 def _maskflag_match(
         flags:   Set[str],
         options: Dict[str, str],
@@ -132,9 +172,114 @@ def _maskflag_match(
     else:
         return options[""]
 
-def mask_compile(mask: str) -> Pattern:
+class CIDRMask(object):
+    # <192.0.2.0/24>, matched against a connection's IP rather than its
+    # `nick!user@host real`
+    def __init__(self,
+            network: Union[IPv4Network, IPv6Network],
+            flags:   Pattern):
+
+        self.network = network
+        self.flags   = flags
+        # what COMPILEMASK shows
+        self.pattern = f"{flags.pattern}<{network}>"
+
+    def search(self, ref: str) -> bool:
+        # the slow way, for e.g. TESTMASK. live matching looks IPs up in a
+        # CIDRTable instead
+        if self.flags.match(ref) is None:
+            return False
+        _, _, hostmask = ref.partition("\n")
+        host = hostmask.split(" ", 1)[0].rpartition("@")[2]
+        try:
+            return ip_address(host) in self.network
+        except ValueError:
+            return False
+
+# what mask_compile gives back
+Mask       = Union[Pattern, CIDRMask]
+CIDRMaskId = Tuple[int, CIDRMask]
+
+class CIDRTable(object):
+    # CIDR masks by address family, then prefix length, then network address.
+    # looking an IP up costs one dict lookup per prefix length in use, no
+    # matter how many ranges there are
+    def __init__(self, masks: List[Tuple[int, CIDRMask]]):
+        # version: prefix length: network address >> host bits: masks
+        self._table: Dict[int, Dict[int, Dict[int, List[CIDRMaskId]]]] = {}
+        for mask_id, cmask in masks:
+            network  = cmask.network
+            prefixes = self._table.setdefault(network.version, {})
+            networks = prefixes.setdefault(network.prefixlen, {})
+            key      = int(network.network_address) >> (
+                network.max_prefixlen - network.prefixlen
+            )
+            networks.setdefault(key, []).append((mask_id, cmask))
+        self._count = len(masks)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def lookup(self,
+            ip:     str,
+            uflags: str
+            ) -> List[int]:
+
+        try:
+            address = ip_address(ip)
+        except ValueError:
+            return []
+
+        matches: List[int] = []
+        address_i = int(address)
+        bits      = address.max_prefixlen
+        prefixes  = self._table.get(address.version, {})
+        for prefixlen, networks in prefixes.items():
+            key = address_i >> (bits-prefixlen)
+            for mask_id, cmask in networks.get(key, []):
+                if cmask.flags.match(uflags) is not None:
+                    matches.append(mask_id)
+        return matches
+
+def mask_uflags(user: User, event: Event) -> str:
+    return "".join([
+        "0" if user.account is None   else "1",
+        "0" if not user.secure        else "1",
+        "0" if event == Event.CONNECT else "1",
+        "\n"
+    ])
+
+def mask_references(
+        uflags: str,
+        nick:   str,
+        user:   User
+        ) -> List[str]:
+
+    ni = nick
+    us = user.user
+    ho = user.host
+    ip = user.ip
+    re = user.real
+
+    references = [f"{uflags}{ni}!{us}@{ho} {re}"]
+    if user.ip is not None and not user.host == user.ip:
+        # if the user has an IP and IP != host, also match against IP
+        references.append(f"{uflags}{ni}!{us}@{ip} {re}")
+    return references
+
+def _mask_flags(flags_s: Set[str]) -> str:
+    return "".join([
+        "^",
+        _maskflag_match(flags_s, {'': ".", "A": "0", "a": "1"}),
+        _maskflag_match(flags_s, {'': ".", "Z": "0", "z": "1"}),
+        _maskflag_match(flags_s, {'': "0", "N": "."}),
+        r"\n"
+    ])
+
+def mask_compile(mask: str) -> Mask:
     delim       = mask[0]
-    mask_end    = _find_unescaped(mask, delim)
+    close       = _delim_close(mask)
+    mask_end    = _find_unescaped(mask, close)
     mask, flags = mask[1:mask_end-1], mask[mask_end:]
     flags_s     = set(flags)
 
@@ -149,7 +294,18 @@ def mask_compile(mask: str) -> Pattern:
         flags_invalid_s = "".join(flags_invalid)
         raise ValueError(f"unknown flags '{flags_invalid_s}'")
 
-    if delim in {"\"", "'"}:
+    if close == ">":
+        # CIDR range
+        flags_text = "".join(sorted(flags_s & FLAG_CHARS_TEXT))
+        if flags_text:
+            raise ValueError(f"flags '{flags_text}' don't apply to CIDR masks")
+        try:
+            network = ip_network(mask, strict=False)
+        except ValueError:
+            raise ValueError(f"'{mask}' isn't an IP range")
+        return CIDRMask(network, re.compile(_mask_flags(flags_s)))
+
+    elif delim in {"\"", "'"}:
         # string literal
         mask = _unescape(mask, delim)
         mask = re.escape(mask)
@@ -171,13 +327,7 @@ def mask_compile(mask: str) -> Pattern:
     # re.MULTLINE means the ^ in the mask is still valid, but we were able to
     # insert a secondary matching criteria before the mask with its own ^.
 
-    mask = "".join([
-        "^",
-        _maskflag_match(flags_s, {'': ".", "A": "0", "a": "1"}),
-        _maskflag_match(flags_s, {'': ".", "Z": "0", "z": "1"}),
-        _maskflag_match(flags_s, {'': "0", "N": "."}),
-        r"\n.*"
-    ]) + mask
+    mask = _mask_flags(flags_s) + ".*" + mask
 
     re_flags = re.MULTILINE
     if "i" in flags_s:
@@ -188,7 +338,7 @@ def mask_compile(mask: str) -> Pattern:
 def mask_find(s: str):
     start = s[0]
     if not start.isalnum():
-        end = _find_unescaped(s, start)
+        end = _find_unescaped(s, _delim_close(s))
         if end == -1:
             return end
         else:
@@ -215,6 +365,71 @@ def mask_token(
     mask = format_strip(input[:end])
     return mask, input[end+1:]
 
+# a compiled template is a list of (literal, key) pairs, where `key` names a
+# value to insert after `literal` at render time, or None
+Template = List[Tuple[str, Optional[str]]]
+
+def template_compile(
+        template: str,
+        statics:  Dict[str, str],
+        dynamics: Set[str],
+        depth:    int=10
+        ) -> Template:
+
+    # match "$user_reason" before "$user"
+    keys = sorted(set(statics.keys())|dynamics, key=len, reverse=True)
+
+    out: Template = []
+    literal = ""
+    i = 0
+    while i < len(template):
+        dollar = template.find("$", i)
+        if dollar == -1:
+            literal += template[i:]
+            break
+        literal += template[i:dollar]
+
+        key: Optional[str] = None
+        for key_ in keys:
+            if template.startswith(key_, dollar+1):
+                key = key_
+                break
+
+        if key is None or (key in statics and depth == 0):
+            # not something we can expand
+            literal += "$"
+            i = dollar + 1
+        elif key in statics:
+            # expand reason templates inside reason templates
+            expanded = template_compile(
+                statics[key], statics, dynamics, depth-1
+            )
+            for exp_literal, exp_key in expanded:
+                literal += exp_literal
+                if exp_key is not None:
+                    out.append((literal, exp_key))
+                    literal = ""
+            i = dollar + 1 + len(key)
+        else:
+            out.append((literal, key))
+            literal = ""
+            i = dollar + 1 + len(key)
+
+    out.append((literal, None))
+    return out
+
+def template_render(
+        template: Template,
+        values:   Dict[str, Optional[str]]
+        ) -> str:
+
+    out: List[str] = []
+    for literal, key in template:
+        out.append(literal)
+        if key is not None:
+            out.append(values[key] or "")
+    return "".join(out)
+
 SECONDS_MINUTES = 60
 SECONDS_HOURS   = SECONDS_MINUTES*60
 SECONDS_DAYS    = SECONDS_HOURS*24
@@ -7,7 +7,7 @@ import yaml
 
 @dataclass
 class Config(object):
-    server:   str
+    servers:  List[str]
     nickname: str
     username: str
     realname: str
@@ -26,6 +26,23 @@ class Config(object):
     cliexitre: Pattern
     clinickre: Pattern
 
+    report_rate:       int
+    report_window:     float
+    oper_cache:        float
+    users_max:         int
+    users_maxage:      int
+    metrics:           Optional[str]
+    lag_threshold:     float
+    reload_interval:   float
+    to_check_max:      int
+    action_ttl:        float
+    velocity_keys:     int
+    cluster_window:    float
+    cluster_threshold: int
+    audit_interval:    float
+    # (role, socket path)
+    sync:              Optional[Tuple[str, str]]
+
 def load(filepath: str):
     with open(filepath) as file:
         config_yaml = yaml.safe_load(file.read())
@@ -38,12 +55,24 @@ def load(filepath: str):
     if "file" in config_yaml["oper"]:
         oper_file = expanduser(config_yaml["oper"]["file"])
 
+    # one server, or a list of servers on the same network to watch
+    servers = config_yaml["server"]
+    if isinstance(servers, str):
+        servers = [servers]
+
+    sync: Optional[Tuple[str, str]] = None
+    if "sync" in config_yaml:
+        sync_role = config_yaml["sync"]["role"]
+        if not sync_role in {"owner", "subscriber"}:
+            raise ValueError(f"unknown sync role '{sync_role}'")
+        sync = (sync_role, expanduser(config_yaml["sync"]["socket"]))
+
     cliconnre = re_compile(config_yaml["cliconnre"])
     cliexitre = re_compile(config_yaml["cliexitre"])
     clinickre = re_compile(config_yaml["clinickre"])
 
     return Config(
-        config_yaml["server"],
+        servers,
         nickname,
         config_yaml.get("username", nickname),
         config_yaml.get("realname", nickname),
@@ -59,4 +88,19 @@ def load(filepath: str):
         cliconnre,
         cliexitre,
         clinickre,
+        config_yaml.get("report_rate", 10),
+        config_yaml.get("report_window", 10.0),
+        config_yaml.get("oper_cache", 60.0),
+        config_yaml.get("users_max", 1_000_000),
+        config_yaml.get("users_maxage", 604_800),
+        config_yaml.get("metrics", None),
+        config_yaml.get("lag_threshold", 1.0),
+        config_yaml.get("reload_interval", 5.0),
+        config_yaml.get("to_check_max", 10_000),
+        config_yaml.get("action_ttl", 60.0),
+        config_yaml.get("velocity_keys", 100_000),
+        config_yaml.get("cluster_window", 60.0),
+        config_yaml.get("cluster_threshold", 20),
+        config_yaml.get("audit_interval", 86400.0),
+        sync,
     )
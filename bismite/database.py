@@ -1,10 +1,11 @@
 from dataclasses import dataclass
 from enum        import Enum
 from time        import time
-from typing      import Dict, List, Optional, Tuple
+from typing      import Any, Dict, List, Optional, Tuple
 import aiosqlite
 
-from .common import MaskAction, mtype_tostring
+from .common  import MaskAction, mtype_tostring
+from .metrics import timed
 
 # schema, also in make-database.sql
 #
@@ -17,6 +18,8 @@ from .common import MaskAction, mtype_tostring
 #   reason:   str
 #   hits:     int not null
 #   last_hit: int not null
+#   velocity: str
+#   shadow:   bool not null
 # primary key id
 #
 # changes:
@@ -25,10 +28,25 @@ from .common import MaskAction, mtype_tostring
 #   time:    int not null
 #   change:  str not null
 #
+# hits: (the last few per mask)
+#   mask_id:   int not null
+#   time:      int not null
+#   reference: str not null
+#
+# masks_search: (fts5, kept up to date by triggers)
+#   rowid:   masks.id
+#   mask:    str
+#   reason:  str
+#   history: str (every change's oper and text)
+#
 # reasons:
 #   key:   str not null
 #   value: str not null
 # primary key key
+#
+# masks_version: (one row, bumped by triggers when masks or reasons change,
+# but not on hit counts)
+#   version: int not null
 
 @dataclass
 class MaskDetails(object):
@@ -38,22 +56,26 @@ class MaskDetails(object):
     reason:   Optional[str]
     hits:     int
     last_hit: int
+    velocity: Optional[str]
+    shadow:   bool
 
 class Table(object):
     def __init__(self, db_location: str):
         self._db_location = db_location
 
 class Masks(Table):
+    @timed
     async def add(self,
             mask:   str,
-            reason: Optional[str]):
+            reason: Optional[str],
+            shadow: bool=False):
 
         async with aiosqlite.connect(self._db_location) as db:
             await db.execute("""
                 INSERT INTO masks
-                (mask, type, enabled, reason, hits, last_hit)
-                VALUES (?, ?, 1, ?, 0, ?)
-            """, [mask, MaskAction.WARN.value, reason, int(time())])
+                (mask, type, enabled, reason, hits, last_hit, shadow)
+                VALUES (?, ?, 1, ?, 0, ?, ?)
+            """, [mask, MaskAction.WARN.value, reason, int(time()), shadow])
             await db.commit()
 
             cursor = await db.execute("""
@@ -64,6 +86,37 @@ class Masks(Table):
             """)
             return (await cursor.fetchone())[0]
 
+    @timed
+    async def add_many(self,
+            # (mask, type, enabled, expire, reason, velocity, shadow)
+            masks:     List[Tuple[str, int, bool, Optional[int],
+                Optional[str], Optional[str], bool]],
+            by_source: str,
+            by_oper:   Optional[str]
+            ) -> List[int]:
+
+        # all or nothing, along with their `changes` rows
+        now = int(time())
+        ids: List[int] = []
+        async with aiosqlite.connect(self._db_location) as db:
+            for mask, mtype, enabled, expire, reason, velocity, shadow in masks:
+                cursor = await db.execute("""
+                    INSERT INTO masks
+                    (mask, type, enabled, expire, reason, hits, last_hit,
+                        velocity, shadow)
+                    VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+                """, [mask, mtype, enabled, expire, reason, now, velocity,
+                    shadow])
+                ids.append(cursor.lastrowid)
+            await db.executemany("""
+                INSERT INTO changes
+                (mask_id, by_source, by_oper, time, change)
+                VALUES (?, ?, ?, ?, 'import')
+            """, [(mask_id, by_source, by_oper, now) for mask_id in ids])
+            await db.commit()
+        return ids
+
+    @timed
     async def has_id(self, mask_id: int) -> bool:
         async with aiosqlite.connect(self._db_location) as db:
             cursor = await db.execute("""
@@ -73,29 +126,35 @@ class Masks(Table):
             """, [mask_id])
             return bool(await cursor.fetchall())
 
+    @timed
     async def get(self,
             mask_id: int
             ) -> Tuple[str, MaskDetails]:
 
         async with aiosqlite.connect(self._db_location) as db:
             cursor = await db.execute("""
-                SELECT mask, type, enabled, expire, reason, hits, last_hit
+                SELECT mask, type, enabled, expire, reason, hits, last_hit,
+                    velocity, shadow
                 FROM masks
                 WHERE id=?
             """, [mask_id])
 
             row = await cursor.fetchone()
-            mask, mtype, enabled, expire, reason, hits, last_hit = row
+            (mask, mtype, enabled, expire, reason, hits, last_hit,
+                velocity, shadow) = row
             details = MaskDetails(
                 mtype,
                 enabled,
                 expire,
                 reason,
                 hits,
-                last_hit
+                last_hit,
+                velocity,
+                bool(shadow)
             )
             return (mask, details)
 
+    @timed
     async def toggle(self, mask_id: int) -> bool:
         async with aiosqlite.connect(self._db_location) as db:
             cursor = await db.execute("""
@@ -115,6 +174,7 @@ class Masks(Table):
 
             return enabled
 
+    @timed
     async def set_type(self,
             mask_id: int,
             mtype:   int):
@@ -127,6 +187,7 @@ class Masks(Table):
             """, [mtype, mask_id])
             await db.commit()
 
+    @timed
     async def set_expire(self,
             mask_id: int,
             expire:  Optional[int]):
@@ -139,21 +200,50 @@ class Masks(Table):
             """, [expire, mask_id])
             await db.commit()
 
-    async def hit(self, mask_id: int):
+    @timed
+    async def set_velocity(self,
+            mask_id:  int,
+            velocity: Optional[str]):
+
         async with aiosqlite.connect(self._db_location) as db:
-            cursor = await db.execute("""
-                SELECT hits
-                FROM masks
+            await db.execute("""
+                UPDATE masks
+                SET velocity=?
                 WHERE id=?
-            """, [mask_id])
-            hits = (await cursor.fetchone())[0]
+            """, [velocity, mask_id])
+            await db.commit()
+
+    @timed
+    async def set_shadow(self,
+            mask_id: int,
+            shadow:  bool):
+
+        async with aiosqlite.connect(self._db_location) as db:
             await db.execute("""
                 UPDATE masks
-                SET hits=?,last_hit=?
+                SET shadow=?
                 WHERE id=?
-            """, [hits+1, int(time()), mask_id])
+            """, [shadow, mask_id])
             await db.commit()
 
+    @timed
+    async def hit(self,
+            mask_id:  int,
+            hits:     int=1,
+            last_hit: Optional[int]=None):
+
+        if last_hit is None:
+            last_hit = int(time())
+
+        async with aiosqlite.connect(self._db_location) as db:
+            await db.execute("""
+                UPDATE masks
+                SET hits=hits+?,last_hit=MAX(last_hit, ?)
+                WHERE id=?
+            """, [hits, last_hit, mask_id])
+            await db.commit()
+
+    @timed
     async def list_enabled(self
             ) -> List[Tuple[int, str]]:
         async with aiosqlite.connect(self._db_location) as db:
@@ -165,7 +255,93 @@ class Masks(Table):
             """)
             return await cursor.fetchall()
 
+    @timed
+    async def list_details(self,
+            disabled: bool=False
+            ) -> List[Tuple[int, str, MaskDetails]]:
+        async with aiosqlite.connect(self._db_location) as db:
+            cursor = await db.execute("""
+                SELECT id, mask, type, enabled, expire, reason, hits, last_hit,
+                    velocity, shadow
+                FROM masks
+                WHERE enabled = 1 OR ?
+                ORDER BY id ASC
+            """, [disabled])
+            return [
+                (mask_id, mask, MaskDetails(*details))
+                for mask_id, mask, *details in await cursor.fetchall()
+            ]
+
+    @timed
+    async def find(self,
+            text:    Optional[str],
+            action:  Optional[int],
+            enabled: Optional[bool],
+            oper:    Optional[str],
+            newer:   Optional[int],
+            older:   Optional[int],
+            limit:   int,
+            offset:  int
+            ) -> Tuple[int, List[Tuple[int, str, MaskDetails]]]:
+
+        # newest first. returns how many masks matched in all, and `limit`
+        # of them from `offset`
+        where:  List[str] = []
+        params: List[Any] = []
+        if text is not None:
+            # as one phrase, so FTS5 query syntax isn't a thing opers need to
+            # know. the trigram tokenizer makes this a substring search
+            where.append("""id IN (
+                SELECT rowid FROM masks_search WHERE masks_search MATCH ?
+            )""")
+            params.append('"' + text.replace('"', '""') + '"')
+        if action is not None:
+            where.append("(type & 15) = ?")
+            params.append(action)
+        if enabled is not None:
+            where.append("enabled = ?")
+            params.append(enabled)
+        if oper is not None:
+            # whoever added it
+            where.append("""(
+                SELECT by_oper FROM changes WHERE mask_id=masks.id
+                ORDER BY time, rowid LIMIT 1
+            ) = ?""")
+            params.append(oper)
+        if newer is not None or older is not None:
+            added = "(SELECT MIN(time) FROM changes WHERE mask_id=masks.id)"
+            if newer is not None:
+                where.append(f"{added} >= ?")
+                params.append(newer)
+            if older is not None:
+                where.append(f"{added} < ?")
+                params.append(older)
+
+        async with aiosqlite.connect(self._db_location) as db:
+            cursor = await db.execute(f"""
+                SELECT COUNT(*) OVER (), id, mask, type, enabled, expire,
+                    reason, hits, last_hit, velocity, shadow
+                FROM masks
+                WHERE {" AND ".join(where) or "1"}
+                ORDER BY id DESC
+                LIMIT ? OFFSET ?
+            """, params + [limit, offset])
+            rows = await cursor.fetchall()
+
+        if not rows and offset > 0:
+            # past the last page; still say how many there are
+            total, _ = await self.find(
+                text, action, enabled, oper, newer, older, 1, 0
+            )
+            return (total, [])
+        total = rows[0][0] if rows else 0
+        return (total, [
+            (mask_id, mask, MaskDetails(*details))
+            for _, mask_id, mask, *details in rows
+        ])
+
 class Changes(Table):
+    @timed
     async def add(self,
             mask_id:   int,
             by_source: str,
@@ -180,6 +356,7 @@ class Changes(Table):
             """, [mask_id, by_source, by_oper, int(time()), action])
             await db.commit()
 
+    @timed
     async def get(self,
             mask_id: int
             ) -> List[Tuple[str, int, str]]:
@@ -194,7 +371,49 @@ class Changes(Table):
             return await cursor.fetchall()
 
 
+class Hits(Table):
+    @timed
+    async def add(self,
+            hits: List[Tuple[int, int, str]],
+            keep: int):
+
+        async with aiosqlite.connect(self._db_location) as db:
+            await db.executemany("""
+                INSERT INTO hits (mask_id, time, reference)
+                VALUES (?, ?, ?)
+            """, hits)
+            # only the most recent `keep` per mask
+            await db.executemany("""
+                DELETE FROM hits
+                WHERE mask_id=? AND rowid NOT IN (
+                    SELECT rowid
+                    FROM hits
+                    WHERE mask_id=?
+                    ORDER BY time DESC, rowid DESC
+                    LIMIT ?
+                )
+            """, [(i, i, keep) for i in {mask_id for mask_id, _, _ in hits}])
+            await db.commit()
+
+    @timed
+    async def get(self,
+            mask_id: int,
+            count:   int
+            ) -> List[Tuple[int, str]]:
+
+        async with aiosqlite.connect(self._db_location) as db:
+            cursor = await db.execute("""
+                SELECT time, reference
+                FROM hits
+                WHERE mask_id=?
+                ORDER BY time DESC, rowid DESC
+                LIMIT ?
+            """, [mask_id, count])
+            # oldest first
+            return list(reversed(await cursor.fetchall()))
+
 class Reasons(Table):
+    @timed
     async def add(self,
             key:   str,
             value: str):
@@ -206,6 +425,7 @@ class Reasons(Table):
             """, [key, value])
             await db.commit()
 
+    @timed
     async def has_key(self, key: str) -> bool:
         async with aiosqlite.connect(self._db_location) as db:
             cursor = await db.execute("""
@@ -215,6 +435,7 @@ class Reasons(Table):
             """, [key])
             return bool(await cursor.fetchall())
 
+    @timed
     async def list(self
             ) -> List[Tuple[str, str]]:
         async with aiosqlite.connect(self._db_location) as db:
@@ -224,6 +445,7 @@ class Reasons(Table):
             """)
             return await cursor.fetchall()
 
+    @timed
     async def delete(self, key:str):
         async with aiosqlite.connect(self._db_location) as db:
             cursor = await db.execute("""
@@ -237,4 +459,135 @@ class Database(object):
     def __init__(self, location: str):
         self.masks   = Masks(location)
         self.changes = Changes(location)
+        self.hits    = Hits(location)
         self.reasons = Reasons(location)
+
+        self._location = location
+
+    async def setup(self):
+        # bring databases made by older versions up to date. instances
+        # sharing a database may all do this at once, so check and change
+        # in one write transaction
+        async with aiosqlite.connect(self._location) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cursor  = await db.execute("PRAGMA table_info(masks)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            if not "velocity" in columns:
+                await db.execute("ALTER TABLE masks ADD COLUMN velocity TEXT")
+            if not "shadow" in columns:
+                await db.execute(
+                    "ALTER TABLE masks ADD COLUMN shadow INTEGER NOT NULL"
+                    " DEFAULT 0"
+                )
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS hits (
+                    mask_id   INTEGER NOT NULL,
+                    time      INTEGER NOT NULL,
+                    reference TEXT NOT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS hits_mask_id
+                ON hits (mask_id, time)
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS changes_mask_id
+                ON changes (mask_id, time)
+            """)
+
+            cursor = await db.execute("""
+                SELECT 1
+                FROM sqlite_master
+                WHERE name='masks_search'
+            """)
+            if not await cursor.fetchall():
+                await self._search_setup(db)
+
+            cursor = await db.execute("""
+                SELECT 1
+                FROM sqlite_master
+                WHERE name='masks_version'
+            """)
+            if not await cursor.fetchall():
+                await self._version_setup(db)
+            await db.commit()
+
+    async def _search_setup(self, db: aiosqlite.Connection):
+        await db.execute("""
+            CREATE VIRTUAL TABLE masks_search USING fts5(
+                mask, reason, history, tokenize='trigram'
+            )
+        """)
+        await db.execute("""
+            CREATE TRIGGER masks_search_insert AFTER INSERT ON masks BEGIN
+                INSERT INTO masks_search (rowid, mask, reason, history)
+                VALUES (new.id, new.mask, COALESCE(new.reason, ''), '');
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER masks_search_update AFTER UPDATE OF mask, reason
+            ON masks BEGIN
+                UPDATE masks_search
+                SET mask=new.mask, reason=COALESCE(new.reason, '')
+                WHERE rowid=new.id;
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER masks_search_delete AFTER DELETE ON masks BEGIN
+                DELETE FROM masks_search WHERE rowid=old.id;
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER changes_search_insert AFTER INSERT ON changes BEGIN
+                UPDATE masks_search
+                SET history=history || ' ' || COALESCE(new.by_oper, '')
+                    || ' ' || new.change
+                WHERE rowid=new.mask_id;
+            END
+        """)
+        # and everything from before there was an index
+        await db.execute("""
+            INSERT INTO masks_search (rowid, mask, reason, history)
+            SELECT id, mask, COALESCE(reason, ''), COALESCE((
+                SELECT GROUP_CONCAT(COALESCE(by_oper, '') || ' ' || change, ' ')
+                FROM changes
+                WHERE mask_id=masks.id
+            ), '')
+            FROM masks
+        """)
+
+    async def _version_setup(self, db: aiosqlite.Connection):
+        await db.execute("""
+            CREATE TABLE masks_version (
+                version INTEGER NOT NULL
+            )
+        """)
+        await db.execute("""
+            INSERT INTO masks_version (version) VALUES (0)
+        """)
+        # not on hits or last_hit, which change with every match
+        triggers = [
+            ("masks_version_insert", "INSERT ON masks"),
+            ("masks_version_update", "UPDATE OF mask, type, enabled, expire,"
+                " reason, velocity, shadow ON masks"),
+            ("masks_version_delete", "DELETE ON masks"),
+            ("reasons_version_insert", "INSERT ON reasons"),
+            ("reasons_version_update", "UPDATE ON reasons"),
+            ("reasons_version_delete", "DELETE ON reasons")
+        ]
+        for name, event in triggers:
+            await db.execute(f"""
+                CREATE TRIGGER {name} AFTER {event} BEGIN
+                    UPDATE masks_version SET version=version+1;
+                END
+            """)
+
+    @timed
+    async def masks_version(self) -> int:
+        # moves whenever anyone changes a mask or a reason
+        async with aiosqlite.connect(self._location) as db:
+            cursor = await db.execute("""
+                SELECT version
+                FROM masks_version
+            """)
+            return (await cursor.fetchone())[0]
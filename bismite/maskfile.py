@@ -0,0 +1,161 @@
+import asyncio, json, re
+from collections import Counter
+from dataclasses import dataclass
+from typing      import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .common   import Mask, MaskAction, mask_compile, mask_token
+from .common   import mtype_fromstring, mtype_tostring
+from .database import MaskDetails
+from .velocity import velocity_parse, velocity_tostring
+
+# one mask per line, either JSON as written by EXPORTMASKS:
+#   {"mask": "/re/", "type": "LETHAL", "enabled": true, "expire": null,
+#    "reason": "...", "velocity": null, "shadow": false}
+# or ADDMASK's arguments, which are imported as enabled WARN masks:
+#   /re/ reason
+# blank lines and lines starting with "#" are skipped
+
+@dataclass
+class MaskImport(object):
+    mask:     str
+    type:     int
+    enabled:  bool
+    expire:   Optional[int]
+    reason:   Optional[str]
+    velocity: Optional[str]
+    shadow:   bool
+
+def mask_export(
+        mask:    str,
+        details: MaskDetails
+        ) -> str:
+
+    return json.dumps({
+        "mask":     mask,
+        "type":     mtype_tostring(details.type),
+        "enabled":  bool(details.enabled),
+        "expire":   details.expire,
+        "reason":   details.reason,
+        "velocity": details.velocity,
+        "shadow":   bool(details.shadow)
+    })
+
+def _parse_json(line: str) -> MaskImport:
+    try:
+        obj: Dict[str, Any] = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"bad json: {str(e)}")
+    if not isinstance(obj, dict) or not isinstance(obj.get("mask"), str):
+        raise ValueError("no mask")
+
+    expire = obj.get("expire", None)
+    if expire is not None and not isinstance(expire, int):
+        raise ValueError("expire must be a number or null")
+    velocity = obj.get("velocity", None)
+    if velocity is not None:
+        velocity = velocity_tostring(velocity_parse(str(velocity)))
+
+    return MaskImport(
+        obj["mask"],
+        mtype_fromstring(str(obj.get("type", "WARN"))),
+        bool(obj.get("enabled", True)),
+        expire,
+        obj.get("reason", None),
+        velocity,
+        bool(obj.get("shadow", False))
+    )
+
+def _parse_line(line: str) -> MaskImport:
+    if line.startswith("{"):
+        return _parse_json(line)
+
+    mask, reason = mask_token(line)
+    reason = reason.strip()
+    if not reason:
+        raise ValueError("no mask reason")
+    return MaskImport(
+        mask, MaskAction.WARN.value, True, None, reason, None, False
+    )
+
+def masks_parse(
+        lines: Iterable[str]
+        ) -> Tuple[List[MaskImport], List[str]]:
+
+    imports: List[MaskImport] = []
+    errors:  List[str] = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            imports.append(_parse_line(line))
+        except ValueError as e:
+            errors.append(f"line {i+1}: {str(e)}")
+    return (imports, errors)
+
+def masks_read(path: str) -> Tuple[List[MaskImport], List[str]]:
+    # run in an executor thread, away from the event loop
+    with open(path, encoding="utf8") as file:
+        return masks_parse(file)
+
+def masks_write(
+        path:  str,
+        masks: Sequence[Tuple[int, str, MaskDetails]]
+        ):
+
+    # run in an executor thread, away from the event loop. never over
+    # something that's already there
+    with open(path, "x", encoding="utf8") as file:
+        for _, mask, d in masks:
+            file.write(mask_export(mask, d) + "\n")
+
+def _compile(masks: List[str]) -> List[Tuple[Optional[Mask], str]]:
+    # run in an executor thread, away from the event loop
+    out: List[Tuple[Optional[Mask], str]] = []
+    for mask in masks:
+        try:
+            out.append((mask_compile(mask), ""))
+        except (ValueError, re.error) as e:
+            out.append((None, str(e)))
+    return out
+
+async def masks_compile(
+        imports:    List[MaskImport],
+        chunk_size: int=100
+        ) -> Tuple[List[Mask], List[str]]:
+
+    # chunks are compiled side by side on the default executor
+    loop   = asyncio.get_running_loop()
+    chunks = await asyncio.gather(*(
+        loop.run_in_executor(
+            None, _compile, [m.mask for m in imports[i:i+chunk_size]]
+        )
+        for i in range(0, len(imports), chunk_size)
+    ))
+
+    cmasks: List[Mask] = []
+    errors: List[str] = []
+    for i, (cmask, error) in enumerate(c for chunk in chunks for c in chunk):
+        if cmask is None:
+            errors.append(f"{imports[i].mask}: {error}")
+        else:
+            cmasks.append(cmask)
+    return (cmasks, errors)
+
+def history_scan(
+        cmasks:  Sequence[Mask],
+        history: Sequence[List[str]]
+        ) -> Tuple[int, Counter]:
+
+    # how many recent connections any of `cmasks` would have hit, and how
+    # many each of them would have
+    hit = 0
+    per_mask: Counter[int] = Counter()
+    for references in history:
+        matched = False
+        for i, cmask in enumerate(cmasks):
+            if any(cmask.search(reference) for reference in references):
+                per_mask[i] += 1
+                matched      = True
+        hit += matched
+    return (hit, per_mask)
@@ -0,0 +1,147 @@
+import asyncio
+from bisect    import bisect_left
+from functools import wraps
+from time      import perf_counter
+from typing    import Any, Callable, Dict, Iterable, List, Tuple
+
+# (name, labels)
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+# (name, labels, value)
+Sample    = Tuple[str, Dict[str, str], float]
+
+BUCKETS = [
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0
+]
+
+def _key(name: str, labels: Dict[str, str]) -> MetricKey:
+    return (name, tuple(sorted(labels.items())))
+
+def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels_s = ",".join(
+        f'{k}="{v}"' for k, v in labels
+    )
+    return f"{{{labels_s}}}" if labels_s else ""
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS)+1)
+        self.sum    = 0.0
+        self.count  = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+class Metrics(object):
+    # just enough of the prometheus text exposition format for our counters,
+    # histograms and point-in-time gauges
+    def __init__(self):
+        self._counters:   Dict[MetricKey, float] = {}
+        self._histograms: Dict[MetricKey, Histogram] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def inc(self, name: str, value: float=1, **labels: str):
+        key = _key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = _key(name, labels)
+        if not key in self._histograms:
+            self._histograms[key] = Histogram()
+        self._histograms[key].observe(value)
+
+    def collector(self, func: Callable[[], Iterable[Sample]]):
+        # called at scrape time, for gauges (queue depths etc)
+        self._collectors.append(func)
+
+    def render(self) -> str:
+        outs: List[str] = []
+        typed: Dict[str, str] = {}
+        def _type(name: str, mtype: str):
+            if not name in typed:
+                typed[name] = mtype
+                outs.append(f"# TYPE {name} {mtype}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            _type(name, "counter")
+            outs.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), hist in sorted(self._histograms.items()):
+            _type(name, "histogram")
+            cumulative = 0
+            for bucket, count in zip(BUCKETS + [None], hist.counts):
+                cumulative += count
+                le = "+Inf" if bucket is None else repr(bucket)
+                bucket_labels = labels + (("le", le),)
+                outs.append(
+                    f"{name}_bucket{_labels(bucket_labels)} {cumulative}"
+                )
+            outs.append(f"{name}_sum{_labels(labels)} {hist.sum}")
+            outs.append(f"{name}_count{_labels(labels)} {hist.count}")
+
+        # samples of the same gauge have to be grouped together
+        gauges: Dict[str, List[str]] = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append(
+                    f"{name}{_labels(sorted(labels.items()))} {value}"
+                )
+        for name, samples in gauges.items():
+            _type(name, "gauge")
+            outs.extend(samples)
+
+        return "\n".join(outs) + "\n"
+
+METRICS = Metrics()
+
+def timed(func: Callable[..., Any]):
+    # record how long a database query took, labelled e.g. "masks.get"
+    query = func.__qualname__.lower()
+    @wraps(func)
+    async def _timed(*args: Any, **kwargs: Any):
+        start = perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            METRICS.observe(
+                "bismite_db_query_seconds", perf_counter()-start, query=query
+            )
+    return _timed
+
+async def _http_client(
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter):
+
+    try:
+        # we serve the same thing for every path, so skip the request
+        while True:
+            line = await reader.readline()
+            if line in {b"\r\n", b"\n", b""}:
+                break
+
+        body = METRICS.render().encode("utf8")
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def serve(address: str):
+    # "host:port", or "unix:/path/to.sock"
+    if address.startswith("unix:"):
+        server = await asyncio.start_unix_server(
+            _http_client, address[5:]
+        )
+    else:
+        host, _, port = address.rpartition(":")
+        server = await asyncio.start_server(
+            _http_client, host.strip("[]") or "127.0.0.1", int(port)
+        )
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,168 @@
+import asyncio, os, sqlite3, tempfile
+from argparse    import ArgumentParser
+from collections import Counter, deque
+from time        import monotonic
+from typing      import Any, Deque, List, Tuple
+
+from irctokens import Line, tokenise
+from ircrobots.interface import SendPriority
+
+from ircstates.numerics import *
+
+from .         import Bot, Server
+from .common   import Event, User, mtype_tostring
+from .config   import Config, load as config_load
+from .database import Database
+
+class ReplayServer(Server):
+    # a Server that's never connected anywhere. what it would have sent is
+    # thrown away, apart from actions, which are counted
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.hits:    Counter[int] = Counter()
+        self.actions: List[Tuple[int, str]] = []
+        self.checked = 0
+
+    def send(self, line: Line, priority=SendPriority.DEFAULT):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    async def _mask_act(self,
+            mask_id: int,
+            mtype:   int,
+            action:  str):
+        self.actions.append((mask_id, action))
+
+    async def _mask_match(self,
+            nick:  str,
+            user:  User,
+            event: Event
+            ) -> Tuple[List[int], List[str]]:
+
+        self.checked += 1
+        matches, references = await super()._mask_match(nick, user, event)
+        self.hits.update(matches)
+        return (matches, references)
+
+def _read_capture(path: str):
+    # accepts the `< `/`> ` output of line_preread/line_presend, or raw lines
+    with open(path, encoding="utf8", errors="replace") as capture:
+        for rawline in capture:
+            rawline = rawline.rstrip("\r\n")
+            if rawline.startswith("> ") or not rawline:
+                continue
+            elif rawline.startswith("< "):
+                rawline = rawline[2:]
+            yield tokenise(rawline)
+
+# lines that'd make us talk to the network or reload masks
+SKIP_COMMANDS = {"PRIVMSG", "PING", RPL_WELCOME}
+
+async def replay(
+        config:   Config,
+        capture:  str,
+        window:   int,
+        verbose:  bool):
+
+    # replay against a copy of the database, so hit counts aren't touched
+    with tempfile.TemporaryDirectory(prefix="bismite-replay-") as workdir:
+        database = os.path.join(workdir, "masks.db")
+        source   = sqlite3.connect(config.database)
+        target   = sqlite3.connect(database)
+        source.backup(target)
+        source.close()
+        target.close()
+
+        await _replay(config, database, capture, window, verbose)
+
+async def _replay(
+        config:   Config,
+        database: str,
+        capture:  str,
+        window:   int,
+        verbose:  bool):
+
+    db     = Database(database)
+    await db.setup()
+    bot    = Bot(config, db)
+    server = ReplayServer(bot, "replay", config, db)
+    server.nickname = config.nickname
+    await bot.masks_load()
+
+    # connections waiting for their WHOIS to finish, as delayed_check would
+    waiting: Deque[Tuple[int, str, User]] = deque()
+    async def _check(nick: str, user: User):
+        if user.connected:
+            await server.mask_check(nick, user, Event.CONNECT)
+
+    lines = 0
+    start = monotonic()
+    for line in _read_capture(capture):
+        if line.command in SKIP_COMMANDS:
+            continue
+        lines += 1
+        server.parse_tokens(line)
+        await server.line_read(line)
+
+        while server.to_check:
+            _, nick, user = server.to_check.popleft()
+            waiting.append((lines, nick, user))
+
+        if line.command == RPL_ENDOFWHOIS and len(line.params) > 1:
+            nick = line.params[1]
+            for i, (_, wnick, wuser) in enumerate(waiting):
+                if wnick == nick:
+                    del waiting[i]
+                    await _check(wnick, wuser)
+                    break
+        # nobody answered our WHOIS; check with what we have
+        while waiting and waiting[0][0] + window < lines:
+            _, nick, user = waiting.popleft()
+            await _check(nick, user)
+
+    while waiting:
+        _, nick, user = waiting.popleft()
+        await _check(nick, user)
+
+    elapsed = monotonic() - start
+
+    actions: Counter[int] = Counter()
+    commands: Counter[str] = Counter()
+    for mask_id, action in server.actions:
+        actions[mask_id] += 1
+        commands[action.split(" ", 1)[0].upper()] += 1
+
+    print(f"{lines} lines in {elapsed:.2f}s"
+        f" ({lines/max(elapsed, 1e-9):.0f} lines/s),"
+        f" {server.checked} connections checked")
+    for mask_id, hits in sorted(server.hits.items()):
+        mask, d = await db.masks.get(mask_id)
+        mtype_str = mtype_tostring(d.type)
+        print(f"{str(mask_id).rjust(4)}: {hits} hits,"
+            f" {actions[mask_id]} actions, {mtype_str} {mask}")
+
+    if commands:
+        print("would have sent: " + ", ".join(
+            f"{count} {command}" for command, count in commands.most_common()
+        ))
+    else:
+        print("would have sent no actions")
+    if verbose:
+        for mask_id, action in server.actions:
+            print(f"  [{mask_id}] {action}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="replay captured server lines through mask matching"
+    )
+    parser.add_argument("config")
+    parser.add_argument("capture", help="file of `< `-prefixed or raw lines")
+    parser.add_argument("--window", type=int, default=1000,
+        help="lines to wait for a connection's WHOIS reply before checking it")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="print every action that would have been taken")
+    args = parser.parse_args()
+
+    config = config_load(args.config)
+    asyncio.run(replay(config, args.capture, args.window, args.verbose))
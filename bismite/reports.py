@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing      import Dict, List, Tuple
+from typing      import OrderedDict as TOrderedDict
+
+@dataclass
+class _Summary(object):
+    mtype:      str
+    hits:       int
+    sample:     str
+    suppressed: int
+
+class ReportAggregator(object):
+    # individual report lines are let through until `rate` have been sent to
+    # a channel within the current `window`. after that, further hits are
+    # counted per mask and sent as one summary line per mask when the window
+    # is flushed
+    def __init__(self,
+            rate:   int,
+            window: float):
+
+        self._rate   = rate
+        self.window  = window
+
+        self._sent:    Dict[str, int] = {}
+        self._summary: Dict[str, TOrderedDict[int, _Summary]] = {}
+
+    def add(self,
+            channel:    str,
+            mask_id:    int,
+            mtype:      str,
+            sample:     str,
+            suppressed: bool=False
+            ) -> bool:
+
+        sent = self._sent.get(channel, 0)
+        if sent < self._rate:
+            self._sent[channel] = sent + 1
+            return True
+
+        summaries = self._summary.setdefault(channel, OrderedDict())
+        if not mask_id in summaries:
+            summaries[mask_id] = _Summary(mtype, 0, sample, 0)
+        summaries[mask_id].hits       += 1
+        summaries[mask_id].suppressed += int(suppressed)
+        return False
+
+    def flush(self) -> List[Tuple[str, str]]:
+        outs: List[Tuple[str, str]] = []
+        window = int(self.window)
+        for channel, summaries in self._summary.items():
+            for mask_id, summary in summaries.items():
+                suppressed = ""
+                if summary.suppressed:
+                    suppressed = (f" ({summary.suppressed} duplicate actions"
+                        " suppressed)")
+                outs.append((channel,
+                    f"MASK: {summary.mtype} mask {mask_id}:"
+                    f" {summary.hits} hits in last {window}s{suppressed},"
+                    f" sample: {summary.sample}"
+                ))
+
+        self._sent.clear()
+        self._summary.clear()
+        return outs
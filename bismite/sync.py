@@ -0,0 +1,130 @@
+import asyncio, json, traceback
+from time   import time
+from typing import Any, Dict, List, Set
+
+from .database import Database
+
+# newline-delimited JSON over a unix socket.
+#
+# owner -> subscriber:
+#   {"kind": "mask",   "id": 1, "mask": "/re/", "type": 2, "enabled": true}
+#   {"kind": "reason", "key": "spam", "value": "..."}  (value null: deleted)
+#   {"kind": "refresh"}  (lots has changed, e.g. IMPORTMASKS; reread it all)
+# subscriber -> owner:
+#   {"kind": "hits",   "hits": {"1": [hits, last_hit]}}
+
+class SyncOwner(object):
+    # the instance that owns the database. tells subscribers about mask and
+    # reason changes, and writes the hits they send us
+    def __init__(self,
+            path:     str,
+            database: Database):
+
+        self._path     = path
+        self._database = database
+        self._clients: Set[asyncio.StreamWriter] = set()
+
+    def broadcast(self, event: Dict[str, Any]):
+        line = (json.dumps(event) + "\n").encode("utf8")
+        for writer in list(self._clients):
+            writer.write(line)
+
+    async def _client(self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter):
+
+        self._clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                if event.get("kind", None) == "hits":
+                    for mask_id, (hits, last_hit) in event["hits"].items():
+                        await self._database.masks.hit(
+                            int(mask_id), hits, last_hit
+                        )
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    async def run(self):
+        server = await asyncio.start_unix_server(self._client, self._path)
+        async with server:
+            await server.serve_forever()
+
+class SyncSubscriber(object):
+    # an instance that reads masks from the owner's database but never writes
+    # to it (bar schema updates at startup). applies the owner's changes as
+    # they happen and sends hit counts back in batches
+    def __init__(self,
+            path:     str,
+            bot:      Any,
+            interval: float=5.0):
+
+        self._path     = path
+        self._bot      = bot
+        self._interval = interval
+        # mask id: [hits, last hit]
+        self._hits: Dict[int, List[int]] = {}
+
+    def hit(self, mask_id: int, hits: int=1):
+        if mask_id in self._hits:
+            self._hits[mask_id][0] += hits
+            self._hits[mask_id][1]  = int(time())
+        else:
+            self._hits[mask_id] = [hits, int(time())]
+
+    async def _flush(self, writer: asyncio.StreamWriter):
+        while True:
+            await asyncio.sleep(self._interval)
+            if self._hits:
+                hits, self._hits = self._hits, {}
+                event = {"kind": "hits", "hits": hits}
+                writer.write((json.dumps(event) + "\n").encode("utf8"))
+                await writer.drain()
+
+    async def _apply(self, event: Dict[str, Any]):
+        kind = event.get("kind", None)
+        if kind == "mask":
+            self._bot.mask_update(
+                event["id"], event["mask"], event["enabled"],
+                event.get("shadow", False)
+            )
+            # the owner has committed by now, so its details are there to read
+            await self._bot.mask_changed(event["id"])
+        elif kind == "reason":
+            self._bot.reason_update(event["key"], event["value"])
+        elif kind == "refresh":
+            await self._bot.masks_refresh()
+
+    async def run(self):
+        backoff = 1.0
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self._path
+                )
+            except OSError:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff*2, 60.0)
+                continue
+
+            backoff = 1.0
+            # we may have missed changes while we weren't connected
+            await self._bot.masks_load()
+            flush = asyncio.create_task(self._flush(writer))
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    await self._apply(json.loads(line))
+            except Exception:
+                traceback.print_exc()
+            finally:
+                flush.cancel()
+                writer.close()
@@ -1,30 +1,33 @@
-import asyncio, re
+import asyncio, re, traceback
 from datetime import datetime
+from os.path  import basename
 from heapq    import heappop
 from time     import monotonic, time
-from typing   import List, Optional, Tuple
+from typing   import Awaitable, List, Optional, Tuple
 
 from irctokens import build
 from ircrobots import Bot, Server
+from ircrobots.interface import SendPriority
 
 from ircstates.numerics import *
 from ircrobots.matching import ANY, Folded, Response, SELF
 
 from .common   import Event, mtype_getaction, mtype_tostring, MaskAction
 from .database import Database
+from .metrics  import METRICS
+from .watchdog import Watchdog
 
 async def delayed_send(bot: Bot):
     while True:
         await asyncio.sleep(0.1)
 
-        if bot.servers:
-            server = list(bot.servers.values())[0]
-            now = monotonic()
+        now = monotonic()
+        for server in list(bot.servers.values()):
             while server.delayed_send:
                 when, sline = server.delayed_send[0]
                 if when <= now:
                     heappop(server.delayed_send)
-                    await server.send_raw(sline)
+                    await server.send_raw(sline, SendPriority.HIGH)
                 else:
                     break
 
@@ -36,8 +39,7 @@ async def delayed_check(
         now  = monotonic()
         wait = 0.1
 
-        if bot.servers:
-            server = list(bot.servers.values())[0]
+        for server in list(bot.servers.values()):
             while server.to_check:
                 ts, nick, user = server.to_check[0]
                 due = ts+delay
@@ -47,11 +49,87 @@ async def delayed_check(
                     if user.connected:
                         await server.mask_check(nick, user, Event.CONNECT)
                 else:
-                    wait = due-now
+                    wait = min(wait, due-now)
                     break
 
         await asyncio.sleep(wait)
 
+async def record_hits(bot: Bot):
+    while True:
+        # write whatever's built up since last time as one batch
+        hits = [await bot.hit_queue.get()]
+        while not bot.hit_queue.empty():
+            hits.append(bot.hit_queue.get_nowait())
+
+        try:
+            await bot.hits_record(hits)
+        except Exception:
+            traceback.print_exc()
+
+async def send_reports(bot: Bot):
+    while True:
+        server, *report = await bot.report_queue.get()
+        await server.reports_send(*report)
+
+async def shadow_check(bot: Bot):
+    while True:
+        references = await bot.shadow_queue.get()
+        bot.shadow_check(references)
+
+async def cluster_feed(bot: Bot):
+    while True:
+        nick, user = await bot.cluster_queue.get()
+        bot.clusters.add(nick, user)
+
+async def cluster_alerts(
+        bot:    Bot,
+        window: float):
+
+    while True:
+        await asyncio.sleep(window)
+
+        spikes = bot.clusters.flush()
+        if not spikes or not bot.servers:
+            continue
+        server = list(bot.servers.values())[0]
+        for spike in spikes:
+            suggest = ""
+            if spike.mask is not None:
+                suggest = f" suggest: addmask {spike.mask} <reason>"
+            await server._verbose(
+                f"CLUSTER: {spike.field} \x02{spike.value}\x02:"
+                f" {spike.count} connections in last {int(window)}s"
+                f" (was {spike.baseline}).{suggest}"
+            )
+
+async def report_summaries(bot: Bot):
+    while True:
+        wait = 10.0
+
+        for server in list(bot.servers.values()):
+            wait = server.reports.window
+            for channel, summary in server.reports.flush():
+                await server._report(channel, summary)
+
+        await asyncio.sleep(wait)
+
+async def watch_overload(
+        bot:      Bot,
+        interval: float=5.0):
+
+    while True:
+        await asyncio.sleep(interval)
+
+        for server in list(bot.servers.values()):
+            await server.degraded_update()
+
+async def reap_users(bot: Bot):
+    while True:
+        await asyncio.sleep(60)
+
+        for server in list(bot.servers.values()):
+            server.reap_users()
+
 async def expire_masks(
         bot: Bot,
         db:  Database):
@@ -60,13 +138,15 @@ async def expire_masks(
         now  = int(time())
         wait = 60.0
 
-        if not bot.servers:
+        if not bot.servers or not bot.owns_masks:
+            # subscribers hear about expiries from the owner
             await asyncio.sleep(wait)
             continue
 
         server = list(bot.servers.values())[0]
         source = f"{server.nickname}!{server.username}@{server.hostname}"
-        for mask_id in list(server.active_masks.keys()):
+        # masks are shared between servers, so only expire them once
+        for mask_id in list(bot.active_masks.keys()):
             mask, details = await db.masks.get(mask_id)
 
             if details.expire is None:
@@ -90,6 +170,7 @@ async def expire_masks(
                 # downgrade to WARN
                 await db.masks.set_type(mask_id, MaskAction.WARN)
                 await db.changes.add(mask_id, source, '', "expire to WARN")
+                await bot.mask_changed(mask_id)
                 await server.report(
                     f"MASK:EXPIRE: \x02{mask}\x02 {mtype_str} -> WARN"
                 )
@@ -98,9 +179,122 @@ async def expire_masks(
                 await db.masks.set_expire(mask_id, None)
                 await db.masks.toggle(mask_id)
                 await db.changes.add(mask_id, source, '', "expire")
-                del server.active_masks[mask_id]
+                bot.mask_update(mask_id, mask, False)
+                await bot.mask_changed(mask_id)
                 await server.report(
                     f"MASK:EXPIRE: \x02{mask}\x02 {mtype_str}"
                 )
 
         await asyncio.sleep(wait)
+
+async def reload_masks(
+        bot:      Bot,
+        db:       Database,
+        interval: float):
+
+    version = await db.masks_version()
+    while True:
+        await asyncio.sleep(interval)
+
+        # cheap to ask, and only moves when a mask or reason has changed.
+        # that includes our own changes, which are already applied
+        latest = await db.masks_version()
+        if latest == version:
+            continue
+        version = latest
+
+        masks, reasons = await bot.masks_refresh()
+        if (masks or reasons) and bot.servers:
+            server = list(bot.servers.values())[0]
+            await server._verbose(
+                f"RELOAD: {masks} masks and {reasons} reasons changed"
+                " in the database"
+            )
+
+async def audit_masks(
+        bot:      Bot,
+        interval: float):
+
+    while True:
+        await asyncio.sleep(interval)
+        if bot.auditing:
+            # someone's asked for one with AUDITMASKS -run
+            continue
+
+        bot.auditing = True
+        try:
+            audit = await bot.masks_audit()
+            if bot.servers:
+                server = list(bot.servers.values())[0]
+                await server._verbose(
+                    f"AUDIT: {len(audit.dead)} dead, {len(audit.subsumed)}"
+                    f" subsumed and {len(audit.overlaps)} overlapping masks"
+                    f" against last {audit.samples} users. see AUDITMASKS"
+                )
+        except Exception:
+            # try again next time rather than never again
+            traceback.print_exc()
+
+async def loop_monitor(
+        bot:       Bot,
+        threshold: float,
+        interval:  float=0.25,
+        frames:    int=5):
+
+    watchdog = Watchdog(threshold)
+    watchdog.start()
+
+    while True:
+        watchdog.beat()
+        start = monotonic()
+        await asyncio.sleep(interval)
+        lag   = max(0.0, monotonic() - start - interval)
+        METRICS.observe("bismite_loop_lag_seconds", lag)
+        if lag < threshold:
+            continue
+
+        # what the loop was busy doing while it wasn't scheduling us
+        stack = watchdog.take_stack() or traceback.StackSummary()
+        print(f"event loop stalled for {lag:.2f}s")
+        print("".join(stack.format()))
+
+        if bot.servers:
+            server = list(bot.servers.values())[0]
+            await server._verbose(f"LAG: event loop stalled for {lag:.2f}s")
+            for frame in stack[-frames:]:
+                await server._verbose(
+                    f"LAG:  {basename(frame.filename)}:{frame.lineno}"
+                    f" {frame.name}(): {frame.line}"
+                )
+
+def all_timers(
+        bot:             Bot,
+        db:              Database,
+        check_delay:     int=3,
+        lag_threshold:   float=1.0,
+        reload_interval: float=5.0,
+        cluster_window:  float=60.0,
+        audit_interval:  float=86400.0
+        ) -> List[Awaitable]:
+
+    timers = [
+        delayed_send(bot),
+        delayed_check(bot, check_delay),
+        record_hits(bot),
+        send_reports(bot),
+        shadow_check(bot),
+        expire_masks(bot, db),
+        report_summaries(bot),
+        reap_users(bot),
+        watch_overload(bot)
+    ]
+    if lag_threshold > 0:
+        timers.append(loop_monitor(bot, lag_threshold))
+    if reload_interval > 0:
+        timers.append(reload_masks(bot, db, reload_interval))
+    if cluster_window > 0:
+        timers.append(cluster_feed(bot))
+        timers.append(cluster_alerts(bot, cluster_window))
+    if audit_interval > 0:
+        timers.append(audit_masks(bot, audit_interval))
+    return timers
@@ -0,0 +1,68 @@
+import asyncio, sys, traceback
+from argparse import ArgumentParser
+
+from .config   import Config, load as config_load
+from .database import Database
+from .maskfile import masks_compile, masks_read, masks_write
+
+async def _import(
+        config: Config,
+        path:   str
+        ) -> int:
+
+    imports, errors = masks_read(path)
+    _, compile_errors = await masks_compile(imports)
+    for error in errors + compile_errors:
+        print(error, file=sys.stderr)
+    if errors or compile_errors:
+        print("nothing imported", file=sys.stderr)
+        return 1
+
+    db  = Database(config.database)
+    await db.setup()
+    ids = await db.masks.add_many(
+        [
+            (m.mask, m.type, m.enabled, m.expire, m.reason, m.velocity,
+                m.shadow)
+            for m in imports
+        ],
+        "bismite.transfer", None
+    )
+    # a running owner picks these up within `reload_interval`
+    print(f"imported {len(ids)} masks ({ids[0]}-{ids[-1]})" if ids else
+        "no masks to import")
+    return 0
+
+async def _export(
+        config: Config,
+        path:   str
+        ) -> int:
+
+    db    = Database(config.database)
+    await db.setup()
+    masks = await db.masks.list_details(disabled=True)
+    try:
+        masks_write(path, masks)
+    except FileExistsError:
+        print(f"{path} already exists", file=sys.stderr)
+        return 1
+    print(f"exported {len(masks)} masks")
+    return 0
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="import or export masks in bulk")
+    parser.add_argument("config")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("file")
+    args = parser.parse_args()
+
+    config = config_load(args.config)
+    try:
+        if args.action == "import":
+            code = asyncio.run(_import(config, args.file))
+        else:
+            code = asyncio.run(_export(config, args.file))
+    except OSError:
+        traceback.print_exc()
+        code = 1
+    sys.exit(code)
@@ -0,0 +1,136 @@
+import traceback
+from collections import OrderedDict
+from ipaddress   import ip_address
+from time        import monotonic
+from typing      import Dict, Optional, Tuple
+from typing      import OrderedDict as TOrderedDict
+
+from .common import from_pretty_time, to_pretty_time, User
+
+# what a velocity mask counts its matches by. without one, it counts every
+# match of the mask together
+VELOCITY_KEYS = {"net", "ip", "user", "host", "real"}
+
+# (count, window seconds, key)
+Velocity = Tuple[int, int, Optional[str]]
+
+def velocity_parse(spec: str) -> Velocity:
+    # "50/1m", "5/30:net"
+    spec, _, key = spec.partition(":")
+    count_s, _, window_s = spec.partition("/")
+
+    if not count_s.isdigit() or not int(count_s) > 0:
+        raise ValueError("velocity count must be a number above 0")
+    if window_s.isdigit():
+        window: Optional[int] = int(window_s)
+    else:
+        window = from_pretty_time(window_s)
+    if not window:
+        raise ValueError("velocity window must be seconds or e.g. 1h30m")
+    if key and not key in VELOCITY_KEYS:
+        keys = ", ".join(sorted(VELOCITY_KEYS))
+        raise ValueError(f"unknown velocity key '{key}' (one of {keys})")
+
+    return (int(count_s), window, key or None)
+
+def velocity_tostring(velocity: Velocity) -> str:
+    count, window, key = velocity
+    pretty = to_pretty_time(window)
+    if from_pretty_time(pretty) == window:
+        out = f"{count}/{pretty}"
+    else:
+        # from_pretty_time doesn't do seconds, and to_pretty_time only gives
+        # the two biggest units
+        out = f"{count}/{window}"
+    if key is not None:
+        out += f":{key}"
+    return out
+
+def _key(
+        key:  Optional[str],
+        user: User
+        ) -> str:
+
+    if key is None:
+        return ""
+    elif key in {"net", "ip"}:
+        ip = user.ip if user.ip is not None else user.host
+        if key == "net":
+            if ":" in ip:
+                try:
+                    # /64
+                    return ip_address(ip).exploded[:19]
+                except ValueError:
+                    pass
+            else:
+                # /24
+                return ip.rpartition(".")[0]
+        return ip
+    else:
+        return getattr(user, key)
+
+class _Window(object):
+    __slots__ = ("start", "previous", "current")
+    def __init__(self, start: float):
+        self.start    = start
+        self.previous = 0
+        self.current  = 0
+
+class VelocityCounter(object):
+    # an approximate sliding window per (mask, key): counts for the current
+    # and previous windows, with the previous one weighted by how much of it
+    # is still inside the sliding window. O(1) per match, and we keep at most
+    # `max_keys` of them, forgetting the least recently matched first
+    def __init__(self, max_keys: int):
+        self._max_keys = max_keys
+        self._windows: TOrderedDict[Tuple[int, str], _Window] = OrderedDict()
+        self._parsed:  Dict[str, Optional[Velocity]] = {}
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def hit(self,
+            mask_id: int,
+            spec:    str,
+            user:    User
+            ) -> bool:
+
+        # has this mask now matched often enough to act?
+        if not spec in self._parsed:
+            try:
+                self._parsed[spec] = velocity_parse(spec)
+            except ValueError:
+                # e.g. set by hand in the database. act like a normal mask
+                traceback.print_exc()
+                self._parsed[spec] = None
+        parsed = self._parsed[spec]
+        if parsed is None:
+            return True
+        count, window, key = parsed
+
+        now  = monotonic()
+        wkey = (mask_id, _key(key, user))
+        if wkey in self._windows:
+            counter = self._windows[wkey]
+            self._windows.move_to_end(wkey)
+        else:
+            counter = self._windows[wkey] = _Window(now)
+            if len(self._windows) > self._max_keys:
+                self._windows.popitem(last=False)
+
+        elapsed = now - counter.start
+        if elapsed >= window*2:
+            # cold; nothing in either window counts any more
+            counter.start    = now
+            counter.previous = 0
+            counter.current  = 0
+            elapsed = 0.0
+        elif elapsed >= window:
+            counter.start   += window
+            counter.previous = counter.current
+            counter.current  = 0
+            elapsed -= window
+
+        counter.current += 1
+        estimate = counter.current + counter.previous * (1 - elapsed/window)
+        return estimate >= count
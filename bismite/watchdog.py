@@ -0,0 +1,35 @@
+import sys, threading, traceback
+from time   import monotonic, sleep
+from typing import Optional
+
+class Watchdog(threading.Thread):
+    # the event loop can't tell us what it's stuck on while it's stuck, so
+    # watch its heartbeat from another thread and grab the loop thread's stack
+    # once it's been quiet for longer than `threshold`
+    def __init__(self, threshold: float):
+        super().__init__(name="bismite-watchdog", daemon=True)
+        self._threshold = threshold
+        self._loop_ident = threading.get_ident()
+
+        self._heartbeat = monotonic()
+        self._captured: Optional[float] = None
+        self._stack:    Optional[traceback.StackSummary] = None
+
+    def beat(self):
+        self._heartbeat = monotonic()
+
+    def take_stack(self) -> Optional[traceback.StackSummary]:
+        # the stack captured during the last stall, if any
+        stack, self._stack = self._stack, None
+        return stack
+
+    def run(self):
+        while True:
+            sleep(self._threshold / 4)
+            heartbeat = self._heartbeat
+            if (monotonic() - heartbeat > self._threshold and
+                    not self._captured == heartbeat):
+                self._captured = heartbeat
+                frame = sys._current_frames().get(self._loop_ident, None)
+                if frame is not None:
+                    self._stack = traceback.extract_stack(frame)
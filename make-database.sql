@@ -8,7 +8,9 @@ CREATE TABLE masks (
     expire   INTEGER,
     reason   TEXT,
     hits     INTEGER NOT NULL,
-    last_hit INTEGER NOT NULL
+    last_hit INTEGER NOT NULL,
+    velocity TEXT,
+    shadow   INTEGER NOT NULL DEFAULT 0
 );
 CREATE TABLE changes (
     mask_id   INTEGER NOT NULL,
@@ -17,8 +19,58 @@ CREATE TABLE changes (
     time      INTEGER NOT NULL,
     change    TEXT NOT NULL
 );
+CREATE INDEX changes_mask_id ON changes (mask_id, time);
+CREATE VIRTUAL TABLE masks_search USING fts5(
+    mask, reason, history, tokenize='trigram'
+);
+CREATE TRIGGER masks_search_insert AFTER INSERT ON masks BEGIN
+    INSERT INTO masks_search (rowid, mask, reason, history)
+    VALUES (new.id, new.mask, COALESCE(new.reason, ''), '');
+END;
+CREATE TRIGGER masks_search_update AFTER UPDATE OF mask, reason ON masks BEGIN
+    UPDATE masks_search
+    SET mask=new.mask, reason=COALESCE(new.reason, '')
+    WHERE rowid=new.id;
+END;
+CREATE TRIGGER masks_search_delete AFTER DELETE ON masks BEGIN
+    DELETE FROM masks_search WHERE rowid=old.id;
+END;
+CREATE TRIGGER changes_search_insert AFTER INSERT ON changes BEGIN
+    UPDATE masks_search
+    SET history=history || ' ' || COALESCE(new.by_oper, '') || ' ' || new.change
+    WHERE rowid=new.mask_id;
+END;
+CREATE TABLE hits (
+    mask_id   INTEGER NOT NULL,
+    time      INTEGER NOT NULL,
+    reference TEXT NOT NULL
+);
+CREATE INDEX hits_mask_id ON hits (mask_id, time);
 CREATE TABLE reasons (
     key   TEXT NOT NULL PRIMARY KEY,
     value TEXT NOT NULL
 );
+CREATE TABLE masks_version (
+    version INTEGER NOT NULL
+);
+INSERT INTO masks_version (version) VALUES (0);
+CREATE TRIGGER masks_version_insert AFTER INSERT ON masks BEGIN
+    UPDATE masks_version SET version=version+1;
+END;
+CREATE TRIGGER masks_version_update AFTER UPDATE OF
+    mask, type, enabled, expire, reason, velocity, shadow ON masks BEGIN
+    UPDATE masks_version SET version=version+1;
+END;
+CREATE TRIGGER masks_version_delete AFTER DELETE ON masks BEGIN
+    UPDATE masks_version SET version=version+1;
+END;
+CREATE TRIGGER reasons_version_insert AFTER INSERT ON reasons BEGIN
+    UPDATE masks_version SET version=version+1;
+END;
+CREATE TRIGGER reasons_version_update AFTER UPDATE ON reasons BEGIN
+    UPDATE masks_version SET version=version+1;
+END;
+CREATE TRIGGER reasons_version_delete AFTER DELETE ON reasons BEGIN
+    UPDATE masks_version SET version=version+1;
+END;
 COMMIT;